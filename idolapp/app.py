@@ -1,113 +1,1963 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Request, render_template, request, jsonify, redirect, url_for, g, Response, stream_with_context, send_file, abort, has_app_context
+from flask.cli import AppGroup
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 import sqlite3
-import firebase_admin
-from firebase_admin import credentials, auth
+import threading
+import queue
+import time
+import hashlib
+import hmac
+import json
+import bisect
+import heapq
+import itertools
+import atexit
+import functools
+import re
+import random
+import cProfile
+import gzip
+import mimetypes
+import tempfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
 import os
-from werkzeug.utils import secure_filename
 import datetime
 from dotenv import load_dotenv
+from google.auth import jwt as google_jwt
+from google.auth import crypt as google_crypt
 
 app = Flask(__name__)
 
 # 画像アップロード設定
 UPLOAD_FOLDER = 'static/icons'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # 環境変数からFirebaseの認証情報を取得
 load_dotenv()
-cred_path = os.getenv("FIREBASE_CREDENTIAL_PATH")
-cred = credentials.Certificate(cred_path)
-firebase_admin.initialize_app(cred)
+# AUTH_TEST_MODE=1 のときはFirebaseに接続せず、ローカルの偽の鍵でトークンを検証する
+app.config['AUTH_TEST_MODE'] = os.getenv("AUTH_TEST_MODE") == '1'
+# AUTO_MIGRATE=1 なら最初のリクエストで未適用のマイグレーションを流す（開発用）
+app.config['AUTO_MIGRATE'] = os.getenv("AUTO_MIGRATE") == '1'
+firebase_project = None
 
-# DB初期化
-def init_db():
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
+def firebase_project_id():
+    # トークン検証はローカルで行うので、必要なのはプロジェクトIDだけ（初回に読む）
+    global firebase_project
+    if firebase_project is None:
+        if app.config['AUTH_TEST_MODE']:
+            firebase_project = os.getenv("FIREBASE_PROJECT_ID", "idolapp-test")
+        elif os.getenv("FIREBASE_PROJECT_ID"):
+            firebase_project = os.getenv("FIREBASE_PROJECT_ID")
+        else:
+            with open(os.getenv("FIREBASE_CREDENTIAL_PATH"), encoding='utf-8') as f:
+                firebase_project = json.load(f)['project_id']
+    return firebase_project
+
+# DB設定（ワーカーごとに接続をプールして使い回す）
+DB_PATH = os.getenv("DATABASE_PATH", "idolapp.db")
+app.config['DATABASE'] = DB_PATH
+app.config['DB_POOL_SIZE'] = int(os.getenv("DB_POOL_SIZE", "8"))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+app.config['DB_CACHE_KB'] = int(os.getenv("DB_CACHE_KB", "16384"))
+app.config['DB_MMAP_SIZE'] = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+app.config['DB_STATEMENT_CACHE'] = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+class ConnectionPool:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'timeouts': 0}
+        self._reset()
+
+    def _reset(self):
+        # gunicornでfork後に親の接続を引き継がないようにPIDごとに作り直す
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.created = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            factory=InstrumentedConnection,
+            timeout=app.config['DB_POOL_TIMEOUT'],
+            check_same_thread=False,
+            cached_statements=app.config['DB_STATEMENT_CACHE'],
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{app.config['DB_CACHE_KB']}")
+        conn.execute(f"PRAGMA mmap_size={app.config['DB_MMAP_SIZE']}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            try:
+                conn = self.idle.get_nowait()
+                self.stats['hits'] += 1
+                return conn
+            except queue.Empty:
+                pass
+            if self.created < self.size:
+                self.created += 1
+                self.stats['misses'] += 1
+                new_conn = True
+            else:
+                new_conn = False
+        if new_conn:
+            try:
+                return self._connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        # 空きがなければ返却を待つ
+        start = time.perf_counter()
+        try:
+            conn = self.idle.get(timeout=app.config['DB_POOL_TIMEOUT'])
+        except queue.Empty:
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise RuntimeError('DB接続プールが枯渇しました')
+        with self.lock:
+            self.stats['waits'] += 1
+            self.stats['wait_time'] += time.perf_counter() - start
+        return conn
+
+    def release(self, conn):
+        if self.pid != os.getpid():
+            return
+        try:
+            # commitされずに残ったトランザクションは捨てる
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self.lock:
+                self.created -= 1
+            return
+        self.idle.put(conn)
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['size'] = self.size
+            data['open'] = self.created
+            data['idle'] = self.idle.qsize()
+        return data
+
+db_pool = ConnectionPool(DB_PATH, app.config['DB_POOL_SIZE'])
+
+def get_db():
+    # 1リクエスト内では同じ接続を使う
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    # どの経路でreturnしても必ずプールへ返却する
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+    for shard, conn in g.pop('shard_dbs', {}).items():
+        post_shards.release(shard, conn)
+
+# 計測（ルートごとの処理時間、SQLごとの時間と行数、トークン検証、JSONエンコード）
+# METRICS_ENABLED=0 なら計測しない。PROFILE_SAMPLE_RATE の割合でcProfileの結果を書き出す
+app.config['METRICS_ENABLED'] = os.getenv("METRICS_ENABLED", "1") == '1'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+app.config['PROFILE_DIR'] = os.getenv("PROFILE_DIR", "profiles")
+# 計測値（/metrics と /api/*_stats）は STATS_TOKEN を決めたときだけ返す
+# Authorization: Bearer <STATS_TOKEN> が付いていなければ、ないものとして404にする
+app.config['STATS_TOKEN'] = os.getenv("STATS_TOKEN", "")
+
+def stats_endpoint(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config['STATS_TOKEN']
+        given = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not token or not hmac.compare_digest(given.encode(), token.encode()):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+class Metrics:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # (名前, ラベル) -> バケットごとの件数 + [件数, 合計秒]
+        self.histograms = {}
+        # SQL -> [実行回数, 合計秒, 行数]
+        self.queries = {}
+
+    def observe(self, name, labels, seconds):
+        if not self.enabled:
+            return
+        i = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * len(self.BUCKETS) + [0, 0.0]
+            if i < len(self.BUCKETS):
+                h[i] += 1
+            h[-2] += 1
+            h[-1] += seconds
+
+    def observe_query(self, sql, seconds, executions, rows):
+        with self.lock:
+            q = self.queries.get(sql)
+            if q is None:
+                q = self.queries[sql] = [0, 0.0, 0]
+            q[0] += executions
+            q[1] += seconds
+            q[2] += rows
+
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+            queries = {k: list(v) for k, v in self.queries.items()}
+        for name in sorted({k[0] for k in histograms}):
+            metric = f'idolapp_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                total = 0
+                for le, count in zip(self.BUCKETS, h):
+                    total += count
+                    lines.append(f'{metric}_bucket{prom_labels(labels + (("le", str(le)),))} {total}')
+                lines.append(f'{metric}_bucket{prom_labels(labels + (("le", "+Inf"),))} {h[-2]}')
+                lines.append(f'{metric}_count{prom_labels(labels)} {h[-2]}')
+                lines.append(f'{metric}_sum{prom_labels(labels)} {h[-1]:.6f}')
+        if queries:
+            for metric, i in (('idolapp_db_query_total', 0), ('idolapp_db_query_seconds_total', 1), ('idolapp_db_query_rows_total', 2)):
+                lines.append(f'# TYPE {metric} counter')
+                for sql, q in sorted(queries.items()):
+                    value = f'{q[i]:.6f}' if i == 1 else q[i]
+                    lines.append(f'{metric}{prom_labels((("sql", sql),))} {value}')
+        return lines
+
+metrics = Metrics(app.config['METRICS_ENABLED'])
+
+def prom_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+@functools.lru_cache(maxsize=1024)
+def query_label(sql):
+    # 空白をつめて、IN (?,?,?) の個数違いは同じSQLとして数える
+    sql = ' '.join(sql.split())
+    return re.sub(r'\?(\s*,\s*\?)+', '?,...', sql)[:200]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # execute と fetch の時間を合わせてそのSQLの時間として数える
+    label = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.label = query_label(sql)
+            metrics.observe_query(self.label, time.perf_counter() - start, 1, 0)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.label = query_label(sql)
+            metrics.observe_query(self.label, time.perf_counter() - start, 1, 0)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        metrics.observe_query(self.label, time.perf_counter() - start, 0, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        metrics.observe_query(self.label, time.perf_counter() - start, 0, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        metrics.observe_query(self.label, time.perf_counter() - start, 0, len(rows))
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    # 計測が無効なら普通のCursorを返すので余計な処理はしない
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = InstrumentedCursor if metrics.enabled else sqlite3.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if not metrics.enabled:
+            return super().dumps(obj, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            metrics.observe('json_encode', (), time.perf_counter() - start)
+
+app.json = TimedJSONProvider(app)
+
+@app.before_request
+def start_request_timer():
+    if not metrics.enabled:
+        return
+    g.request_start = time.perf_counter()
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def record_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_timer(exception):
+    if request.environ.get('idolapp.batch'):
+        # /api/batch の中の各リクエストは api_batch 側で測る
+        return
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        name = f"{int(time.time() * 1000)}_{os.getpid()}_{request.endpoint or 'unmatched'}.prof"
+        profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], name))
+    # SSEなどのストリームはレスポンスを返すまでの時間になる
+    status = str(g.pop('response_status', 500))
+    metrics.observe('http_request', (('route', route), ('method', request.method), ('status', status)), elapsed)
+
+# DBスキーマのマイグレーション（PRAGMA user_version で適用済みの番号を管理する）
+# 起動時には実行しない。デプロイ時に flask --app app db upgrade で適用する
+def column_names(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in c.fetchall()}
+
+def add_column(c, table, column, decl):
+    if column not in column_names(c, table):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def migrate_base_schema(c):
+    # これまで init_db / alter_* と手作業で作ってきたテーブルを揃える
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
             uid TEXT PRIMARY KEY,
-            username TEXT,
-            icon_url TEXT,
-            profile TEXT
+            username TEXT
         )
     ''')
+    add_column(c, 'users', 'icon_url', 'TEXT')
+    add_column(c, 'users', 'profile', 'TEXT')
+    add_column(c, 'users', 'mission_cleared', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'point', 'INTEGER DEFAULT 0')
+    add_column(c, 'users', 'level', 'INTEGER DEFAULT 1')
     c.execute('''
         CREATE TABLE IF NOT EXISTS rooms (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL
+            name TEXT NOT NULL
         )
     ''')
+    add_column(c, 'rooms', 'description', 'TEXT')
+    add_column(c, 'rooms', 'creator_uid', 'TEXT')
     c.execute('''
         CREATE TABLE IF NOT EXISTS posts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            room_id INTEGER,
-            uid TEXT,
-            content TEXT,
+            room_id INTEGER NOT NULL,
+            uid TEXT NOT NULL,
+            content TEXT NOT NULL,
             FOREIGN KEY(room_id) REFERENCES rooms(id)
         )
     ''')
+    add_column(c, 'posts', 'likes', 'INTEGER DEFAULT 0')
+    add_column(c, 'posts', 'hearts', 'INTEGER DEFAULT 0')
     c.execute('''
         CREATE TABLE IF NOT EXISTS match_posts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             img_url TEXT,
-            caption TEXT,
-            xAccount TEXT,
+            caption TEXT
+        )
+    ''')
+    add_column(c, 'match_posts', 'xAccount', 'TEXT')
+    add_column(c, 'match_posts', 'uid', 'TEXT')
+    add_column(c, 'match_posts', 'feature', 'TEXT')
+    add_column(c, 'match_posts', 'idolName', 'TEXT')
+    add_column(c, 'match_posts', 'likes', 'INTEGER DEFAULT 0')
+    c.execute("UPDATE match_posts SET likes = 0 WHERE likes IS NULL")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS match_post_likes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER,
+            user_uid TEXT,
+            UNIQUE(post_id, user_uid)
+        )
+    ''')
+
+def migrate_posts_room_index(c):
+    # 部屋ごとの投稿をidの範囲で引くためのインデックス
+    c.execute("CREATE INDEX IF NOT EXISTS idx_posts_room_id ON posts (room_id, id)")
+
+def migrate_image_variants(c):
+    add_column(c, 'users', 'icon_variants', 'TEXT')
+    add_column(c, 'match_posts', 'img_variants', 'TEXT')
+
+def migrate_match_post_tags(c):
+    # タグ検索用テーブル（match_posts.feature の #a#b# を1タグ1行に分解して持つ）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS match_post_tags (
+            tag TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, post_id DESC)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_post_tags_post ON match_post_tags (post_id)")
+    # 投稿が消えたらタグも消す（どの削除APIからでも）
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS match_posts_delete_tags AFTER DELETE ON match_posts
+        BEGIN
+            DELETE FROM match_post_tags WHERE post_id = old.id;
+        END
+    ''')
+    # 既存の投稿から作る
+    c.execute("SELECT id, feature FROM match_posts WHERE feature IS NOT NULL AND feature != ''")
+    rows = [(tag, post_id) for post_id, feature in c.fetchall() for tag in parse_tags(feature)]
+    c.executemany("INSERT OR IGNORE INTO match_post_tags (tag, post_id) VALUES (?, ?)", rows)
+
+def migrate_ranking(c):
+    # ポイント付与の履歴（どの週に何ポイント入ったか）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS point_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT NOT NULL,
+            week_start TEXT NOT NULL,
+            points INTEGER NOT NULL,
+            reason TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 週ごとの合計（付与のたびに加算して持つ）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_scores (
+            week_start TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (week_start, uid)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_weekly_scores_rank ON weekly_scores (week_start, points DESC, uid)")
+    # 締めた週の1位
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_champions (
+            week_start TEXT PRIMARY KEY,
             uid TEXT,
-            feature TEXT,
-            idolName TEXT,
-            likes INTEGER DEFAULT 0
+            points INTEGER
         )
     ''')
-    conn.commit()
-    conn.close()
 
-# 既存DBにカラム追加（初回のみ実行される）
-def alter_users_table():
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN icon_url TEXT")
-    except sqlite3.OperationalError:
-        pass
+def migrate_match_likes_user_index(c):
+    # スワイプのデッキから自分がいいね済みの投稿を除くため
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_post_likes_user ON match_post_likes (user_uid, post_id)")
+
+def migrate_search(c):
+    # 全文検索（日本語は単語で区切れないので trigram で3文字ずつ索引する）
+    # 本文は元のテーブルに置いたまま（external content）、トリガーで索引だけ同期する
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(content, content='posts', content_rowid='id', tokenize='trigram')")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+        BEGIN
+            INSERT INTO posts_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    # いいね数などの更新では索引を触らない
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF content ON posts
+        BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO posts_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS match_posts_fts USING fts5(caption, idolName, content='match_posts', content_rowid='id', tokenize='trigram')")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS match_posts_fts_insert AFTER INSERT ON match_posts
+        BEGIN
+            INSERT INTO match_posts_fts (rowid, caption, idolName) VALUES (new.id, new.caption, new.idolName);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS match_posts_fts_delete AFTER DELETE ON match_posts
+        BEGIN
+            INSERT INTO match_posts_fts (match_posts_fts, rowid, caption, idolName) VALUES ('delete', old.id, old.caption, old.idolName);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS match_posts_fts_update AFTER UPDATE OF caption, idolName ON match_posts
+        BEGIN
+            INSERT INTO match_posts_fts (match_posts_fts, rowid, caption, idolName) VALUES ('delete', old.id, old.caption, old.idolName);
+            INSERT INTO match_posts_fts (rowid, caption, idolName) VALUES (new.id, new.caption, new.idolName);
+        END
+    ''')
+    # 既存の行から索引を作る
+    c.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+    c.execute("INSERT INTO match_posts_fts (match_posts_fts) VALUES ('rebuild')")
+
+def migrate_delete_jobs(c):
+    # 大量削除は印を付けて読み取りから隠し、バックグラウンドで少しずつ消す
+    add_column(c, 'rooms', 'deleted', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(c, 'match_posts', 'deleted', 'INTEGER NOT NULL DEFAULT 0')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS delete_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            total INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            claimed_at REAL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_delete_jobs_status ON delete_jobs (status, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_posts_uid ON match_posts (uid, id)")
+    # 画像ファイルを他の投稿がまだ使っているか調べる
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_posts_img_url ON match_posts (img_url)")
+
+def migrate_champion_images(c):
+    # 週ごとのチャンピオン画像（誰がいつ上げたか）。ホーム画面はここから読み、ディレクトリは見ない
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS champion_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            week_start TEXT NOT NULL,
+            uid TEXT,
+            hash TEXT,
+            width INTEGER,
+            height INTEGER,
+            url TEXT NOT NULL,
+            variants TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_champion_images_week ON champion_images (week_start, id)")
+    # これまでに置かれたファイルは更新日時の週として登録する（アップロードした人は分からない）
+    image_dir = os.path.join(app.static_folder, 'champion_images')
+    if not os.path.isdir(image_dir):
+        return
+    c.execute("SELECT url FROM champion_images")
+    known = {row[0] for row in c.fetchall()}
+    for name in sorted(os.listdir(image_dir), key=lambda n: os.path.getmtime(os.path.join(image_dir, n))):
+        url = f'{app.static_url_path}/champion_images/{name}'
+        if url in known or not name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
+            continue
+        path = os.path.join(image_dir, name)
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        week = current_week(datetime.date.fromtimestamp(os.path.getmtime(path)))
+        c.execute("INSERT INTO champion_images (week_start, hash, url) VALUES (?, ?, ?)", (week, digest, url))
+
+def migrate_room_stats(c):
+    # 部屋ごとの投稿数と最後の投稿（部屋一覧を活動順に並べるため）。posts と rooms のトリガーで更新する
+    # 活動順は最後の投稿idの降順（投稿のない部屋は0）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS room_stats (
+            room_id INTEGER PRIMARY KEY,
+            post_count INTEGER NOT NULL DEFAULT 0,
+            last_post_id INTEGER NOT NULL DEFAULT 0,
+            last_post_at TEXT,
+            last_uid TEXT
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_room_stats_activity ON room_stats (last_post_id, room_id)")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_stats_room_insert AFTER INSERT ON rooms BEGIN
+            INSERT OR IGNORE INTO room_stats (room_id) VALUES (new.id);
+        END
+    ''')
+    # 削除中の部屋は一覧から外す（投稿を消している間は更新しない）
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_stats_room_deleted AFTER UPDATE OF deleted ON rooms WHEN new.deleted = 1 BEGIN
+            DELETE FROM room_stats WHERE room_id = new.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_stats_room_delete AFTER DELETE ON rooms BEGIN
+            DELETE FROM room_stats WHERE room_id = old.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_stats_post_insert AFTER INSERT ON posts BEGIN
+            UPDATE room_stats
+            SET post_count = post_count + 1, last_post_id = new.id,
+                last_post_at = CURRENT_TIMESTAMP, last_uid = new.uid
+            WHERE room_id = new.room_id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_stats_post_delete AFTER DELETE ON posts BEGIN
+            UPDATE room_stats SET post_count = post_count - 1 WHERE room_id = old.room_id;
+            UPDATE room_stats
+            SET last_post_id = COALESCE((SELECT MAX(id) FROM posts WHERE room_id = old.room_id), 0),
+                last_uid = (SELECT uid FROM posts WHERE room_id = old.room_id ORDER BY id DESC LIMIT 1)
+            WHERE room_id = old.room_id AND last_post_id = old.id;
+        END
+    ''')
+    c.execute("""
+        INSERT OR IGNORE INTO room_stats (room_id, post_count, last_post_id, last_uid)
+        SELECT r.id,
+               (SELECT COUNT(*) FROM posts WHERE room_id = r.id),
+               COALESCE((SELECT MAX(id) FROM posts WHERE room_id = r.id), 0),
+               (SELECT uid FROM posts WHERE room_id = r.id ORDER BY id DESC LIMIT 1)
+        FROM rooms r
+        WHERE r.deleted = 0
+    """)
+
+def migrate_uploads(c):
+    # 受け取った画像の内容のハッシュと変換結果。同じ画像が種類ごとに1行（重複アップロードの判定に使う）
+    # これより前に上げた画像は元ファイルを残していないので登録しない
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            hash TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            type TEXT,
+            size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            variants TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (hash, kind)
+        )
+    ''')
+
+def migrate_match_post_phash(c):
+    # マッチ投稿の画像の差分ハッシュ（64bitを符号付きで入れる）と、重複として印を付けた投稿の元の投稿id
+    # 既存の投稿は flask --app app match dedup で埋める
+    add_column(c, 'match_posts', 'phash', 'INTEGER')
+    add_column(c, 'match_posts', 'dup_of', 'INTEGER')
+    add_column(c, 'uploads', 'phash', 'INTEGER')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_posts_dup_of ON match_posts (dup_of) WHERE dup_of IS NOT NULL")
+
+def migrate_ranking_buckets(c):
+    # 週ごとのポイントの分布（順位を人数に対して O(log n) で出すため。rank_node を参照）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_score_buckets (
+            week_start TEXT NOT NULL,
+            node INTEGER NOT NULL,
+            users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (week_start, node)
+        ) WITHOUT ROWID
+    ''')
+    # 既存の集計から作る
+    counts = {}
+    c.execute("SELECT week_start, points FROM weekly_scores")
+    for week, points in c.fetchall():
+        for level in range(RANK_LEVELS + 1):
+            key = (week, rank_node(level, points))
+            counts[key] = counts.get(key, 0) + 1
+    c.executemany("INSERT INTO weekly_score_buckets (week_start, node, users) VALUES (?, ?, ?)",
+                  [(week, node, users) for (week, node), users in counts.items()])
+
+# 追加するときは末尾に足す（順番を変えない）
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_posts_room_index,
+    migrate_image_variants,
+    migrate_match_post_tags,
+    migrate_ranking,
+    migrate_match_likes_user_index,
+    migrate_search,
+    migrate_delete_jobs,
+    migrate_champion_images,
+    migrate_room_stats,
+    migrate_uploads,
+    migrate_match_post_phash,
+    migrate_ranking_buckets,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def upgrade_db(path=None):
+    conn = sqlite3.connect(path or DB_PATH, isolation_level=None)
     try:
-        c.execute("ALTER TABLE users ADD COLUMN profile TEXT")
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version in range(current + 1, SCHEMA_VERSION + 1):
+            # 1つずつトランザクションで適用し、成功したら番号を進める
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                MIGRATIONS[version - 1](conn.cursor())
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return current, SCHEMA_VERSION
+    finally:
+        conn.close()
+
+db_cli = AppGroup('db', help='DBのマイグレーション')
+
+@db_cli.command('upgrade')
+def db_upgrade_command():
+    before, after = upgrade_db()
+    print(f'schema version {before} -> {after}')
+
+@db_cli.command('version')
+def db_version_command():
+    conn = sqlite3.connect(DB_PATH)
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
     conn.close()
+    print(f'schema version {current} (latest {SCHEMA_VERSION})')
+
+app.cli.add_command(db_cli)
+
+# チャット投稿のシャード（部屋の投稿を部屋ごとに別のSQLiteファイルへ置く）
+# POST_SHARDS=0（既定）なら今まで通り本体DBの posts を使う。N にすると crc32(room_id) % N 番目の
+# POST_SHARD_DIR/posts_<n>.db に書く。ファイルごとにWALなので、別のシャードの部屋とは書き込みロックを取り合わない
+# 新しい投稿のidは id % N がシャード番号になるように振るので、idだけでシャードが分かる
+# idの上位は投稿時刻（ミリ秒 × N）なので、別のシャードの投稿とも id の大小が投稿の順になる
+# （部屋一覧の活動順と /api/rooms のカーソルは room_stats.last_post_id で比べている）
+# 有効にする前に flask --app app posts split で既存の投稿を分ける。シャード数は後から変えられない
+app.config['POST_SHARDS'] = int(os.getenv("POST_SHARDS", "0"))
+app.config['POST_SHARD_DIR'] = os.getenv("POST_SHARD_DIR", "post_shards")
+app.config['POST_SHARD_POOL_SIZE'] = int(os.getenv("POST_SHARD_POOL_SIZE", "4"))
+
+SHARD_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS shard_meta (
+        shard INTEGER NOT NULL,
+        shards INTEGER NOT NULL,
+        base_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY,
+        room_id INTEGER NOT NULL,
+        uid TEXT NOT NULL,
+        content TEXT NOT NULL,
+        likes INTEGER DEFAULT 0,
+        hearts INTEGER DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_posts_room_id ON posts (room_id, id)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(content, content='posts', content_rowid='id', tokenize='trigram')",
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF content ON posts BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO posts_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+class PostShards:
+    def __init__(self, count, directory):
+        self.count = count
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.pools = [ConnectionPool(self.path(n), app.config['POST_SHARD_POOL_SIZE']) for n in range(count)]
+        self.ready = set()
+        self.stats = {'inserts': 0, 'reaction_retries': 0}
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def path(self, shard):
+        return os.path.join(self.directory, f'posts_{shard}.db')
+
+    def shard_of(self, room_id):
+        return zlib.crc32(str(int(room_id)).encode()) % self.count
+
+    def prepare(self, shard, base_id=None):
+        # ファイルとテーブルを作り、シャード数が設定と合っているか確かめる
+        # base_id: 分割前の投稿の最大id。新しいidはこれより大きくする
+        if base_id is None:
+            main = sqlite3.connect(DB_PATH)
+            try:
+                base_id = main.execute("SELECT COALESCE(MAX(id), 0) FROM posts").fetchone()[0]
+            finally:
+                main.close()
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.path(shard), isolation_level=None, timeout=app.config['DB_POOL_TIMEOUT'])
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql in SHARD_SCHEMA:
+                    conn.execute(sql)
+                row = conn.execute("SELECT shard, shards FROM shard_meta").fetchone()
+                if row is None:
+                    conn.execute("INSERT INTO shard_meta (shard, shards, base_id) VALUES (?, ?, ?)",
+                                 (shard, self.count, base_id))
+                elif row != (shard, self.count):
+                    raise RuntimeError(f'{self.path(shard)} は {row[1]} 分割のシャードです（POST_SHARDS={self.count}）')
+                else:
+                    conn.execute("UPDATE shard_meta SET base_id = MAX(base_id, ?)", (base_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def acquire(self, shard):
+        if shard not in self.ready:
+            with self.lock:
+                if shard not in self.ready:
+                    self.prepare(shard)
+                    self.ready.add(shard)
+        return self.pools[shard].acquire()
+
+    def release(self, shard, conn):
+        self.pools[shard].release(conn)
+
+    def insert(self, conn, shard, room_id, uid, content):
+        # 書き込みロックを取ってから、id % シャード数 == シャード番号 になる次のidを決める
+        # このシャードの最大idと「現在時刻（ミリ秒）× シャード数」の両方より大きい最小の値にする
+        # （JSの数値で正確に扱える 2**53 までに収まるよう、シャード数は数千まで）
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            top = conn.execute("SELECT MAX(COALESCE((SELECT MAX(id) FROM posts), 0), base_id) FROM shard_meta").fetchone()[0]
+            floor = max(top, int(time.time() * 1000) * self.count - 1)
+            post_id = floor - floor % self.count + shard
+            if post_id <= floor:
+                post_id += self.count
+            conn.execute("INSERT INTO posts (id, room_id, uid, content) VALUES (?, ?, ?, ?)",
+                         (post_id, room_id, uid, content))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        with self.lock:
+            self.stats['inserts'] += 1
+        return post_id
+
+    def add_reactions(self, reactions):
+        # {(post_id, 種類): 件数} をシャードごとに1トランザクションで書く。書けなかった分を返す
+        # 分割前からある投稿は id % N が当てにならないので、見つからなければ次のシャードを探す
+        left, failed = dict(reactions), {}
+        for attempt in range(self.count):
+            by_shard = {}
+            for (post_id, kind), n in left.items():
+                by_shard.setdefault((post_id + attempt) % self.count, []).append((post_id, kind, n))
+            left = {}
+            for shard, items in by_shard.items():
+                conn = self.acquire(shard)
+                try:
+                    missed = {}
+                    for post_id, kind, n in items:
+                        column = REACTION_COLUMNS[kind]
+                        cur = conn.execute(f"UPDATE posts SET {column} = COALESCE({column}, 0) + ? WHERE id = ?", (n, post_id))
+                        if not cur.rowcount:
+                            missed[(post_id, kind)] = n
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    app.logger.exception('リアクションの書き込みに失敗しました (shard %s)', shard)
+                    failed.update({(post_id, kind): n for post_id, kind, n in items})
+                    continue
+                finally:
+                    self.release(shard, conn)
+                left.update(missed)
+            if not left:
+                break
+            with self.lock:
+                self.stats['reaction_retries'] += len(left)
+        # どのシャードにもない（消された）投稿の分は捨てる
+        return failed
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+        data['shards'] = self.count
+        for n, pool in enumerate(self.pools):
+            pool_stats = pool.snapshot()
+            data[f'shard{n}_open'] = pool_stats['open']
+            data[f'shard{n}_waits'] = pool_stats['waits']
+        return data
+
+post_shards = PostShards(app.config['POST_SHARDS'], app.config['POST_SHARD_DIR'])
+
+def get_shard_db(shard):
+    dbs = g.setdefault('shard_dbs', {})
+    if shard not in dbs:
+        dbs[shard] = post_shards.acquire(shard)
+    return dbs[shard]
+
+def get_posts_db(room_id):
+    # 部屋の投稿が入っている接続（シャードを使わないときは本体DB）
+    if post_shards.enabled:
+        return get_shard_db(post_shards.shard_of(room_id))
+    return get_db()
+
+posts_cli = AppGroup('posts', help='チャット投稿のシャード')
+
+@posts_cli.command('split')
+def posts_split_command():
+    # 本体DBの posts を POST_SHARDS 個のシャードにコピーする（既にあるidは飛ばすので何度実行してもよい）
+    # 本体DBの posts は消さない。POST_SHARDS=0 に戻せば分割前の投稿で動く（分割後の投稿は戻らない）
+    if not post_shards.enabled:
+        print('POST_SHARDS を1以上にしてください')
+        return
+    main = sqlite3.connect(DB_PATH)
+    base_id = main.execute("SELECT COALESCE(MAX(id), 0) FROM posts").fetchone()[0]
+    conns = []
+    for n in range(post_shards.count):
+        post_shards.prepare(n, base_id)
+        conns.append(sqlite3.connect(post_shards.path(n)))
+    copied = [0] * post_shards.count
+    last_id = 0
+    while True:
+        rows = main.execute("""
+            SELECT id, room_id, uid, content, likes, hearts FROM posts
+            WHERE id > ? ORDER BY id LIMIT 5000
+        """, (last_id,)).fetchall()
+        if not rows:
+            break
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(post_shards.shard_of(row[1]), []).append(row)
+        for n, items in by_shard.items():
+            cur = conns[n].executemany("""
+                INSERT OR IGNORE INTO posts (id, room_id, uid, content, likes, hearts) VALUES (?, ?, ?, ?, ?, ?)
+            """, items)
+            copied[n] += cur.rowcount
+            conns[n].commit()
+        last_id = rows[-1][0]
+    for n, conn in enumerate(conns):
+        total = conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        print(f'shard {n}: copied {copied[n]}, total {total} ({post_shards.path(n)})')
+        conn.close()
+    main.close()
+
+app.cli.add_command(posts_cli)
+
+schema_checked_pid = None
+
+@app.before_request
+def check_schema():
+    # ワーカーごとに最初のリクエストで1回だけ確認する
+    global schema_checked_pid
+    if schema_checked_pid == os.getpid():
+        return
+    schema_checked_pid = os.getpid()
+    conn = sqlite3.connect(DB_PATH)
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    if current < SCHEMA_VERSION:
+        if app.config['AUTO_MIGRATE']:
+            upgrade_db()
+        else:
+            app.logger.error('DBスキーマが古いです (%s < %s)。flask --app app db upgrade を実行してください',
+                             current, SCHEMA_VERSION)
+
+def parse_tags(feature):
+    if not feature:
+        return []
+    feature = feature.replace('＃', '#').replace(' ', '')
+    tags = []
+    for t in feature.split('#'):
+        t = t.strip()
+        if t and t not in tags:
+            tags.append(t)
+    return tags
+
+# アップロードの受け取り
+# multipartのファイルは大きさに関係なく一時ファイルへ（werkzeugのパーサーが64KBずつ）書き、書きながらSHA-256を取る
+# 上限は MAX_CONTENT_LENGTH（全体）と UPLOAD_LIMIT_<種類>（ルートごと）。Content-Length が超えていれば本文を読まずに413
+# 形式は拡張子ではなく先頭のバイトで判定し、元ファイルは UPLOAD_DIR/<ハッシュ先頭2文字>/<ハッシュ> に移す
+# 同じ内容を同じ種類で上げ直した場合は uploads テーブルから前の結果を返し、変換しない
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_CONTENT_LENGTH", str(16 * 1024 * 1024)))
+app.config['UPLOAD_DIR'] = os.getenv("UPLOAD_DIR", "uploads")
+UPLOAD_LIMIT_DEFAULTS = {
+    'icons': 2 * 1024 * 1024,
+    'match_images': 10 * 1024 * 1024,
+    'champion_images': 10 * 1024 * 1024,
+}
+app.config['UPLOAD_LIMITS'] = {kind: int(os.getenv(f"UPLOAD_LIMIT_{kind.upper()}", str(default)))
+                               for kind, default in UPLOAD_LIMIT_DEFAULTS.items()}
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+def sniff_image_type(head):
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+class UnsupportedImage(Exception):
+    pass
+
+class SpooledUpload:
+    # 1ファイル分の一時ファイル。先頭の数バイトは形式の判定用に取っておく
+    HEAD_SIZE = 16
+
+    def __init__(self, directory):
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload_', suffix='.tmp', delete=False)
+        self.path = self.file.name
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        if len(self.head) < self.HEAD_SIZE:
+            self.head += bytes(data[:self.HEAD_SIZE - len(self.head)])
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        # seek / read / close などはファイルにそのまま渡す
+        return getattr(self.file, name)
+
+    def discard(self):
+        self.file.close()
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.path = None
 
-def alter_posts_table():
-    conn = sqlite3.connect("idolapp.db")
+class UploadStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stats = {'uploads': 0, 'bytes': 0, 'dedup_hits': 0, 'stored': 0, 'rejected_type': 0, 'too_large': 0}
+
+    def open_temp(self):
+        # 元ファイルの置き場所と同じファイルシステムに作る（os.replace で移せるように）
+        tmp_dir = os.path.join(self.directory, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        upload = SpooledUpload(tmp_dir)
+        # 保存されずにリクエストが終わったら teardown で消す
+        g.setdefault('uploads', []).append(upload)
+        return upload
+
+    def original_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def check(self, upload):
+        upload.file.flush()
+        image_type = sniff_image_type(upload.head)
+        with self.lock:
+            self.stats['uploads'] += 1
+            self.stats['bytes'] += upload.size
+            if image_type is None:
+                self.stats['rejected_type'] += 1
+        if image_type is None:
+            raise UnsupportedImage()
+        return image_type
+
+    def lookup(self, c, digest, kind):
+        c.execute("SELECT variants, width, height, phash FROM uploads WHERE hash = ? AND kind = ?", (digest, kind))
+        row = c.fetchone()
+        # 差分ハッシュを取る前の行も変換し直す
+        if row is None or row[3] is None:
+            return None
+        variants = json.loads(row[0])
+        # 変換後のファイルが消されていれば作り直す
+        static_prefix = app.static_url_path + '/'
+        if not all(os.path.exists(os.path.join(app.static_folder, url[len(static_prefix):])) for url in variants.values()):
+            return None
+        with self.lock:
+            self.stats['dedup_hits'] += 1
+        return digest, variants, (row[1], row[2]), phash_from_db(row[3])
+
+    def store(self, upload, digest):
+        # 同じ内容のファイルがすでにあっても中身は同じなので上書きしてよい
+        upload.file.close()
+        path = self.original_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(upload.path, path)
+        upload.path = None
+        with self.lock:
+            self.stats['stored'] += 1
+        return path
+
+    def rejected_size(self):
+        with self.lock:
+            self.stats['too_large'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['limits'] = dict(app.config['UPLOAD_LIMITS'])
+        return stats
+
+upload_store = UploadStore(app.config['UPLOAD_DIR'])
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # werkzeugの既定は500KB以下ならメモリに置くが、常に一時ファイルへ書く
+        return upload_store.open_temp()
+
+app.request_class = UploadRequest
+
+@app.teardown_request
+def discard_uploads(exception):
+    for upload in g.pop('uploads', []):
+        upload.discard()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    upload_store.rejected_size()
+    return jsonify({'error': 'ファイルが大きすぎます'}), 413
+
+def upload_limit(kind):
+    # 本文を読む前（request.form に触る前）に上限を決めるので、rate_limited などより外側に付ける
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            request.max_content_length = app.config['UPLOAD_LIMITS'][kind]
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def forget_uploads(c, kind, urls):
+    # 変換後のファイルを消した画像は uploads の行も消し、どの種類でも使われなくなった元ファイルを消す
+    # 呼び出し側のトランザクション内で使う（commitは呼び出し側）
+    hashes = set()
+    for url in urls:
+        name = os.path.basename(url)
+        if not HASHED_NAME.match(name):
+            continue
+        # ファイル名はハッシュの先頭32文字なので主キーの範囲で引く
+        c.execute("SELECT hash FROM uploads WHERE hash >= ? AND hash < ? AND kind = ?", (name[:32], name[:32] + 'g', kind))
+        hashes.update(row[0] for row in c.fetchall())
+    if not hashes:
+        return
+    c.executemany("DELETE FROM uploads WHERE hash = ? AND kind = ?", [(digest, kind) for digest in hashes])
+    for digest in hashes:
+        c.execute("SELECT 1 FROM uploads WHERE hash = ? LIMIT 1", (digest,))
+        if c.fetchone():
+            continue
+        try:
+            os.remove(upload_store.original_path(digest))
+        except FileNotFoundError:
+            pass
+
+# 画像変換はリクエストのスレッドではなくプロセスプールで行う
+app.config['IMAGE_WORKERS'] = int(os.getenv("IMAGE_WORKERS", "2"))
+app.config['IMAGE_MAX_PENDING'] = int(os.getenv("IMAGE_MAX_PENDING", "8"))
+app.config['IMAGE_TIMEOUT'] = float(os.getenv("IMAGE_TIMEOUT", "30"))
+
+class ImageBusy(Exception):
+    pass
+
+image_executor = None
+image_executor_pid = None
+image_slots = threading.BoundedSemaphore(app.config['IMAGE_MAX_PENDING'])
+image_lock = threading.Lock()
+
+def get_image_executor():
+    global image_executor, image_executor_pid
+    with image_lock:
+        if image_executor is None or image_executor_pid != os.getpid():
+            image_executor = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'])
+            image_executor_pid = os.getpid()
+        return image_executor
+
+def upload_image(file, kind):
+    # 戻り値: (内容のハッシュ, {'card': '/static/match_images/xxx_card.webp', ...}, (幅, 高さ), 差分ハッシュ)
+    # ファイルは受け取り時に一時ファイルへ書いてあるので、ここでもプロセスプールにもパスだけを渡す
+    import images  # Pillowの読み込みは初回アップロードまで遅らせる
+    upload = file.stream
+    image_type = upload_store.check(upload)
+    digest = upload.sha256.hexdigest()
+    conn = get_db()
     c = conn.cursor()
+    found = upload_store.lookup(c, digest, kind)
+    if found:
+        return found
+    if not image_slots.acquire(blocking=False):
+        raise ImageBusy()
     try:
-        c.execute("ALTER TABLE posts ADD COLUMN likes INTEGER DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass  # 既に存在する場合は無視
+        future = get_image_executor().submit(images.process_image, upload.path, kind, app.static_folder, digest)
+        digest, names, size, phash = future.result(timeout=app.config['IMAGE_TIMEOUT'])
+    finally:
+        image_slots.release()
+    # 変換できた画像だけ元ファイルとして残す。uploads の行は呼び出し側のcommitで一緒に保存される
+    upload_store.store(upload, digest)
+    variants = {name: url_for('static', filename=f'{kind}/{filename}') for name, filename in names.items()}
+    c.execute("INSERT OR REPLACE INTO uploads (hash, kind, type, size, width, height, phash, variants) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+              (digest, kind, image_type, upload.size, size[0], size[1], phash_to_db(phash), json.dumps(variants)))
+    return digest, variants, size, phash
 
+def process_upload(file, kind):
+    return upload_image(file, kind)[1]
+
+def image_error(e):
+    if isinstance(e, UnsupportedImage):
+        return jsonify({'error': '許可されていないファイル形式です'}), 400
+    if isinstance(e, (ImageBusy, FutureTimeout)):
+        return jsonify({'error': '画像処理が混み合っています。しばらくしてから再度お試しください'}), 503
+    return jsonify({'error': '画像を読み込めませんでした'}), 400
+
+# 静的ファイル配信
+# url_for('static') に内容のハッシュ ?v= を付け、一致するときは1年キャッシュさせる（immutable）
+# アップロード画像はファイル名が内容のハッシュなので最初から immutable
+# flask --app app static build で JS/CSS/HTML の .gz / .br を作っておくと、それをそのまま返す
+# STATIC_SENDFILE=x-sendfile（Apache等）/ x-accel（nginx）なら本体の送信はWebサーバーに任せる
+app.config['STATIC_MAX_AGE'] = int(os.getenv("STATIC_MAX_AGE", str(365 * 24 * 3600)))
+app.config['STATIC_SENDFILE'] = os.getenv("STATIC_SENDFILE", "")
+app.config['STATIC_ACCEL_PREFIX'] = os.getenv("STATIC_ACCEL_PREFIX", "/_static/")
+app.config['USE_X_SENDFILE'] = app.config['STATIC_SENDFILE'] == 'x-sendfile'
+PRECOMPRESS_EXTENSIONS = ('.js', '.css', '.html', '.svg', '.json', '.txt')
+HASHED_NAME = re.compile(r'^[0-9a-f]{32}_')
+static_hashes = {}
+
+def static_fingerprint(filename):
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        return None
     try:
-        c.execute("ALTER TABLE posts ADD COLUMN hearts INTEGER DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass  # 既に存在する場合は無視
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = static_hashes.get(filename)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    static_hashes[filename] = ((st.st_mtime_ns, st.st_size), digest)
+    return digest
 
-    conn.commit()
-    conn.close()
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    filename = values.get('filename')
+    if endpoint != 'static' or not filename or 'v' in values:
+        return
+    if HASHED_NAME.match(os.path.basename(filename)):
+        return
+    digest = static_fingerprint(filename)
+    if digest:
+        values['v'] = digest
+
+def serve_static(filename):
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    immutable = HASHED_NAME.match(os.path.basename(filename)) or \
+        (request.args.get('v') and request.args.get('v') == static_fingerprint(filename))
+    # 圧縮済みのファイルがあり、Rangeでなければそちらを返す
+    encoding = None
+    send_path = path
+    if filename.endswith(PRECOMPRESS_EXTENSIONS) and 'Range' not in request.headers:
+        accepted = request.accept_encodings
+        for enc, ext in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[enc] and os.path.isfile(path + ext) and \
+                    os.path.getmtime(path + ext) >= os.path.getmtime(path):
+                encoding, send_path = enc, path + ext
+                break
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if app.config['STATIC_SENDFILE'] == 'x-accel':
+        rel = os.path.relpath(send_path, app.static_folder).replace(os.sep, '/')
+        resp = Response(mimetype=mimetype)
+        resp.headers['X-Accel-Redirect'] = app.config['STATIC_ACCEL_PREFIX'] + rel
+    else:
+        # Range / If-None-Match は send_file が処理する（x-sendfile なら USE_X_SENDFILE で本文の代わりにヘッダを付ける）
+        resp = send_file(send_path, mimetype=mimetype, conditional=True, etag=True)
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    if filename.endswith(PRECOMPRESS_EXTENSIONS):
+        resp.headers['Vary'] = 'Accept-Encoding'
+    if immutable:
+        resp.headers['Cache-Control'] = f"public, max-age={app.config['STATIC_MAX_AGE']}, immutable"
+    else:
+        # ハッシュなしのURLは毎回ETagで確認させる
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+app.view_functions['static'] = serve_static
+
+static_cli = AppGroup('static', help='静的ファイル')
+
+@static_cli.command('build')
+def static_build_command():
+    # デプロイ時に圧縮済みファイルを作る（brotli は入っていれば作る）
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print('brotli が入っていないので .br は作りません')
+    count = 0
+    for root, _, names in os.walk(app.static_folder):
+        for name in names:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+            count += 1
+    print(f'compressed {count} files')
+
+app.cli.add_command(static_cli)
+
+# IDトークン検証キャッシュ
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+app.config['TOKEN_CACHE_SIZE'] = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+app.config['TOKEN_CLOCK_SKEW'] = int(os.getenv("TOKEN_CLOCK_SKEW", "5"))
+
+class SigningKeys:
+    # Googleの公開鍵をプロセス内に保持し、期限前にバックグラウンドで更新する
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.expires_at = 0
+        self.last_fetch = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.pid = None
+        self.test_signer = None
+
+    def _fetch(self):
+        if app.config['AUTH_TEST_MODE']:
+            return self._test_keys(), 24 * 3600
+        import requests  # 起動を軽くするため使うときに読み込む
+        resp = requests.get(GOOGLE_CERTS_URL, timeout=10)
+        resp.raise_for_status()
+        max_age = 3600
+        for part in resp.headers.get('Cache-Control', '').split(','):
+            part = part.strip()
+            if part.startswith('max-age='):
+                max_age = int(part[len('max-age='):])
+        return resp.json(), max_age
 
-init_db()
-alter_users_table()
-alter_posts_table()
+    def _test_keys(self):
+        # テスト用: 起動ごとにRSA鍵を作ってローカルで署名・検証する
+        # AUTH_TEST_KEY に秘密鍵(PEM)のパスを指定すると、複数プロセスで同じ鍵を使える
+        if self.test_signer is None:
+            from cryptography.hazmat.primitives.asymmetric import rsa
+            from cryptography.hazmat.primitives import serialization
+            key_path = os.getenv("AUTH_TEST_KEY")
+            if key_path and os.path.exists(key_path):
+                with open(key_path, 'rb') as f:
+                    key = serialization.load_pem_private_key(f.read(), password=None)
+            else:
+                key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            private_pem = key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+            public_pem = key.public_key().public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+            if key_path and not os.path.exists(key_path):
+                with open(key_path, 'wb') as f:
+                    f.write(private_pem)
+            self.test_signer = google_crypt.RSASigner.from_string(private_pem, key_id='test-key')
+            self.test_public = public_pem.decode()
+        return {'test-key': self.test_public}
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    def refresh(self):
+        # 取りに行った時刻を先に記録する（失敗しても60秒は取り直さない）
+        with self.lock:
+            self.last_fetch = time.time()
+        keys, max_age = self._fetch()
+        with self.lock:
+            self.keys = keys
+            self.expires_at = time.time() + max_age
+            self.refreshes += 1
+
+    def _loop(self):
+        while True:
+            # 期限の少し前に更新する
+            wait = max(60, (self.expires_at - time.time()) * 0.8)
+            time.sleep(wait)
+            try:
+                self.refresh()
+            except Exception:
+                self._failed()
+
+    def _failed(self):
+        with self.lock:
+            self.errors += 1
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        try:
+            self.refresh()
+        finally:
+            # 最初の取得に失敗しても更新のスレッドは動かす（期限が過ぎているので60秒ごとに取り直す）
+            threading.Thread(target=self._loop, daemon=True).start()
+
+    def get(self, kid):
+        self._ensure_started()
+        key = self.keys.get(kid)
+        # 知らないkidは鍵のローテーション直後の可能性があるので取り直す（連打はしない）
+        # 同時に来たリクエストのうち取りに行くのは1つだけ
+        with self.lock:
+            retry = key is None and time.time() - self.last_fetch > 60
+            if retry:
+                self.last_fetch = time.time()
+        if retry:
+            try:
+                self.refresh()
+            except Exception:
+                self._failed()
+            key = self.keys.get(kid)
+        return key
+
+signing_keys = SigningKeys()
+
+class TokenCache:
+    # トークンのハッシュ -> (uid, exp) のLRU。expを過ぎたものは使わない
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0,
+                      'failures': 0, 'verify_count': 0, 'verify_time': 0.0}
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry[1] <= now:
+                del self.entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, uid, exp):
+        with self.lock:
+            self.entries[key] = (uid, exp)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def record(self, elapsed, ok):
+        with self.lock:
+            self.stats['verify_count'] += 1
+            self.stats['verify_time'] += elapsed
+            if not ok:
+                self.stats['failures'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['size'] = len(self.entries)
+            data['max_size'] = self.size
+        lookups = data['hits'] + data['misses']
+        data['hit_ratio'] = data['hits'] / lookups if lookups else 0.0
+        data['avg_verify_ms'] = data['verify_time'] * 1000 / data['verify_count'] if data['verify_count'] else 0.0
+        data['keys'] = len(signing_keys.keys)
+        data['key_refreshes'] = signing_keys.refreshes
+        data['key_errors'] = signing_keys.errors
+        return data
+
+token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'])
+
+def decode_id_token(id_token):
+    # firebase_admin.auth.verify_id_token と同じ検証をローカルの鍵で行う
+    header = google_jwt.decode_header(id_token)
+    if header.get('alg') != 'RS256':
+        raise ValueError('不正なアルゴリズムです')
+    key = signing_keys.get(header.get('kid'))
+    if key is None:
+        raise ValueError('署名鍵が見つかりません')
+    claims = google_jwt.decode(
+        id_token,
+        certs={header['kid']: key},
+        audience=firebase_project_id(),
+        clock_skew_in_seconds=app.config['TOKEN_CLOCK_SKEW'],
+    )
+    if claims.get('iss') != 'https://securetoken.google.com/' + firebase_project_id():
+        raise ValueError('発行者が一致しません')
+    sub = claims.get('sub')
+    if not isinstance(sub, str) or not sub or len(sub) > 128:
+        raise ValueError('subが不正です')
+    claims['uid'] = sub
+    return claims
+
+def issue_test_token(uid, expires_in=3600):
+    # AUTH_TEST_MODE用: 偽の鍵で署名したIDトークンを発行する（ベンチマーク用）
+    if not app.config['AUTH_TEST_MODE']:
+        raise RuntimeError('AUTH_TEST_MODE=1 のときだけ使えます')
+    signing_keys.get('test-key')
+    now = int(time.time())
+    payload = {
+        'iss': 'https://securetoken.google.com/' + firebase_project_id(),
+        'aud': firebase_project_id(),
+        'sub': uid,
+        'user_id': uid,
+        'auth_time': now,
+        'iat': now,
+        'exp': now + expires_in,
+    }
+    return google_jwt.encode(signing_keys.test_signer, payload).decode()
 
 def verify_token(id_token):
+    # 同じリクエストの中（/api/batch の各リクエストも含む）では同じトークンを1回だけ検証する
+    verified = g.setdefault('verified_tokens', {}) if has_app_context() else {}
+    if id_token and id_token in verified:
+        return verified[id_token]
+    start = time.perf_counter()
+    user, result = check_token(id_token)
+    metrics.observe('verify_token', (('result', result),), time.perf_counter() - start)
+    if id_token:
+        verified[id_token] = user
+    return user
+
+def check_token(id_token):
+    if not id_token:
+        return None, 'missing'
+    key = hashlib.sha256(id_token.encode()).digest()
+    uid = token_cache.get(key)
+    if uid is not None:
+        return {'uid': uid}, 'cached'
+    start = time.perf_counter()
     try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        return {'uid': uid}
+        decoded_token = decode_id_token(id_token)
     except Exception:
-        return None
+        token_cache.record(time.perf_counter() - start, False)
+        return None, 'invalid'
+    token_cache.record(time.perf_counter() - start, True)
+    uid = decoded_token['uid']
+    token_cache.put(key, uid, decoded_token['exp'])
+    return {'uid': uid}, 'verified'
+
+# GETのJSONレスポンスキャッシュ（ETag付き）
+# 書き込み系のAPIが該当する名前空間を無効化する
+app.config['RESPONSE_CACHE_SIZE'] = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+app.config['RESPONSE_CACHE_TTL'] = float(os.getenv("RESPONSE_CACHE_TTL", "30"))
+
+class ResponseCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.namespaces = {}
+        self.generations = {}
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0, 'invalidations': 0}
+
+    def generation(self, namespace):
+        # 名前空間を登録しておく（'posts:*' の無効化で見つけられるように）
+        with self.lock:
+            return self.generations.setdefault(namespace, 0)
+
+    def get(self, namespace, key):
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None or entry[3] < time.time():
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end((namespace, key))
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, namespace, key, generation, body, mimetype):
+        entry = ('"' + hashlib.sha1(body).hexdigest() + '"', body, mimetype,
+                 time.time() + app.config['RESPONSE_CACHE_TTL'])
+        with self.lock:
+            # 計算中に無効化されていたら保存しない
+            if self.generations.get(namespace, 0) != generation:
+                return entry
+            self.entries[(namespace, key)] = entry
+            self.entries.move_to_end((namespace, key))
+            self.namespaces.setdefault(namespace, set()).add(key)
+            while len(self.entries) > self.size:
+                (old_ns, old_key), _ = self.entries.popitem(last=False)
+                self._forget(old_ns, old_key)
+                self.stats['evictions'] += 1
+        return entry
+
+    def _forget(self, namespace, key):
+        keys = self.namespaces.get(namespace)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.namespaces[namespace]
+
+    def not_modified(self):
+        with self.lock:
+            self.stats['not_modified'] += 1
+
+    def invalidate(self, *namespaces):
+        # 'posts:*' のように * で前方一致
+        with self.lock:
+            for namespace in namespaces:
+                if namespace.endswith('*'):
+                    prefix = namespace[:-1]
+                    targets = {ns for ns in self.generations if ns.startswith(prefix)}
+                else:
+                    targets = {namespace}
+                for ns in targets:
+                    self.generations[ns] = self.generations.get(ns, 0) + 1
+                    for key in self.namespaces.pop(ns, ()):
+                        self.entries.pop((ns, key), None)
+                self.stats['invalidations'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['size'] = len(self.entries)
+            data['max_size'] = self.size
+        lookups = data['hits'] + data['misses']
+        data['hit_ratio'] = data['hits'] / lookups if lookups else 0.0
+        return data
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'])
+
+# 同じGETが同時に来たら1回だけDBに問い合わせて結果を分け合う（キャッシュ切れの直後に部屋を見ている全員が来るときなど）
+# 待つのは COALESCE_TIMEOUT 秒まで。先に計算した側が失敗したら自分で計算する
+app.config['COALESCE_TIMEOUT'] = float(os.getenv("COALESCE_TIMEOUT", "5"))
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # キー -> [終了イベント, 結果]
+        self.calls = {}
+        self.stats = {'leaders': 0, 'coalesced': 0, 'fallbacks': 0}
+
+    def do(self, key, fn):
+        # fn の結果が None なら分けずに、待っていた側もそれぞれ計算する
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None]
+                self.stats['leaders'] += 1
+        if not leader:
+            if call[0].wait(app.config['COALESCE_TIMEOUT']) and call[1] is not None:
+                with self.lock:
+                    self.stats['coalesced'] += 1
+                return call[1]
+            with self.lock:
+                self.stats['fallbacks'] += 1
+            return fn()
+        try:
+            call[1] = fn()
+            return call[1]
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call[0].set()
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['in_flight'] = len(self.calls)
+        return data
+
+single_flight = SingleFlight()
+
+def cached_response(namespace):
+    # GETだけキャッシュする。namespaceは文字列か、リクエストから名前空間を作る関数
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # ストリームで返すときは本文を溜めないのでキャッシュしない
+            if request.method != 'GET' or stream_format():
+                return view(*args, **kwargs)
+            ns = namespace() if callable(namespace) else namespace
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = response_cache.get(ns, key)
+            if entry is None:
+                # 200以外の応答は分け合わずに、そのリクエストにだけ返す
+                uncached = []
+                def compute():
+                    generation = response_cache.generation(ns)
+                    resp = app.make_response(view(*args, **kwargs))
+                    if resp.status_code != 200:
+                        uncached.append(resp)
+                        return None
+                    return response_cache.put(ns, key, generation, resp.get_data(), resp.mimetype)
+                entry = single_flight.do((ns, key), compute)
+                if entry is None:
+                    return uncached[0]
+            etag, body, mimetype, _ = entry
+            if etag in request.headers.get('If-None-Match', ''):
+                response_cache.not_modified()
+                return Response(status=304, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+            return Response(body, mimetype=mimetype, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+        return wrapper
+    return decorator
+
+def posts_namespace():
+    return 'posts:' + request.args.get('room_id', '')
+
+# 書き込み系APIのレート制限（ワーカーごとのトークンバケット。ログイン中はuid、そうでなければIPごと）
+# 予算は「回数/秒数」。RATE_LIMIT_POST=20/60 のように環境変数で変えられる
+RATE_LIMIT_DEFAULTS = {
+    'post': '20/60',
+    'reaction': '60/60',
+    'like': '120/60',
+    'match_post': '10/300',
+}
+
+def parse_rate(value):
+    count, period = value.split('/')
+    return int(count), float(period)
+
+# RATE_LIMIT_ENABLED=0 で無効（負荷試験など）
+app.config['RATE_LIMIT_ENABLED'] = os.getenv("RATE_LIMIT_ENABLED", "1") == '1'
+app.config['RATE_LIMITS'] = {name: parse_rate(os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+                             for name, default in RATE_LIMIT_DEFAULTS.items()}
+app.config['RATE_LIMIT_BUCKETS'] = int(os.getenv("RATE_LIMIT_BUCKETS", "100000"))
+# 前段のプロキシ（Herokuのルーターなど）の段数。X-Forwarded-For から接続元のIPを取る
+app.config['PROXY_HOPS'] = int(os.getenv("PROXY_HOPS", "1"))
+if app.config['PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+
+class RateLimiter:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        # (予算名, キー) -> [残り回数, 最後に補充した時刻]。古いものから捨てる（捨てたら満タンからやり直し）
+        self.buckets = OrderedDict()
+        self.rejected = {}
+        self.stats = {'allowed': 0, 'rejected': 0, 'evictions': 0}
+
+    def take(self, name, key):
+        # 通してよければ0、だめなら次に1回分たまるまでの秒数を返す
+        count, period = app.config['RATE_LIMITS'][name]
+        rate = count / period
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get((name, key))
+            if bucket is None:
+                bucket = self.buckets[(name, key)] = [count, now]
+                while len(self.buckets) > self.size:
+                    self.buckets.popitem(last=False)
+                    self.stats['evictions'] += 1
+            else:
+                bucket[0] = min(count, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self.buckets.move_to_end((name, key))
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.stats['allowed'] += 1
+                return 0
+            self.stats['rejected'] += 1
+            self.rejected[name] = self.rejected.get(name, 0) + 1
+            return (1 - bucket[0]) / rate
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['buckets'] = len(self.buckets)
+            for name, n in self.rejected.items():
+                data[f'rejected_{name}'] = n
+        return data
+
+rate_limiter = RateLimiter(app.config['RATE_LIMIT_BUCKETS'])
+
+def rate_limit_key():
+    data = request.get_json(silent=True)
+    id_token = (data.get('idToken') if isinstance(data, dict) else None) or request.form.get('idToken')
+    user = verify_token(id_token) if id_token else None
+    return f"uid:{user['uid']}" if user else f"ip:{request.remote_addr}"
+
+def rate_limited(name):
+    # GETは制限しない
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == 'GET' or not app.config['RATE_LIMIT_ENABLED']:
+                return view(*args, **kwargs)
+            wait = rate_limiter.take(name, rate_limit_key())
+            if wait:
+                resp = jsonify({'error': '操作が多すぎます。しばらく待ってからやり直してください'})
+                resp.status_code = 429
+                resp.headers['Retry-After'] = str(max(1, round(wait)))
+                return resp
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ユーザーの表示用情報（uid -> 名前、アイコン、ポイント、レベル）のLRU
+# 一覧では投稿者をJOINせず、1ページ分のuidをまとめてここから引く
+# 名前とアイコンは変更したワーカーで消す。他のワーカーの変更とポイントはTTLで読み直す
+app.config['USER_CACHE_SIZE'] = int(os.getenv("USER_CACHE_SIZE", "10000"))
+app.config['USER_CACHE_TTL'] = float(os.getenv("USER_CACHE_TTL", "60"))
+
+class UserCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        # uid -> ((username, icon_url, point, level), 読み込んだ時刻)
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'queries': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_many(self, uids):
+        found = {}
+        missing = []
+        expire = time.time() - app.config['USER_CACHE_TTL']
+        with self.lock:
+            for uid in uids:
+                entry = self.entries.get(uid)
+                if entry is None or entry[1] < expire:
+                    missing.append(uid)
+                    continue
+                self.entries.move_to_end(uid)
+                found[uid] = entry[0]
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(missing)
+        if missing:
+            c = get_db().cursor()
+            c.execute(f"SELECT uid, username, icon_url, point, level FROM users WHERE uid IN ({','.join('?' * len(missing))})",
+                      missing)
+            loaded = {row[0]: row[1:] for row in c.fetchall()}
+            now = time.time()
+            with self.lock:
+                self.stats['queries'] += 1
+                for uid in missing:
+                    # 登録されていないuidも覚えておく
+                    summary = loaded.get(uid, (None, None, None, None))
+                    found[uid] = summary
+                    self.entries[uid] = (summary, now)
+                    self.entries.move_to_end(uid)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+        return found
+
+    def get(self, uid):
+        return self.get_many([uid])[uid]
+
+    def invalidate(self, uid):
+        with self.lock:
+            self.entries.pop(uid, None)
+            self.stats['invalidations'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['size'] = len(self.entries)
+            data['max_size'] = self.size
+        lookups = data['hits'] + data['misses']
+        data['hit_ratio'] = data['hits'] / lookups if lookups else 0.0
+        return data
+
+user_cache = UserCache(app.config['USER_CACHE_SIZE'])
+
+def with_authors(rows, uid_col):
+    # 各行の末尾に投稿者の (username, icon_url) を足す
+    users = user_cache.get_many({row[uid_col] for row in rows if row[uid_col]})
+    return [row + users.get(row[uid_col], (None, None))[:2] for row in rows]
+
+# 件数の多い一覧は ?stream=1 でJSON配列を、?stream=ndjson（または Accept: application/x-ndjson）で
+# 1行1件のJSONを、fetchmanyで少しずつ読みながら返す
+app.config['STREAM_CHUNK_ROWS'] = int(os.getenv("STREAM_CHUNK_ROWS", "500"))
+
+def stream_format():
+    value = request.args.get('stream')
+    if value == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        return 'ndjson'
+    if value == '1':
+        return 'array'
+    return None
+
+def stream_rows(c, to_dict, fmt, authors):
+    def generate():
+        first = True
+        if fmt == 'array':
+            yield b'['
+        while True:
+            rows = c.fetchmany(app.config['STREAM_CHUNK_ROWS'])
+            if not rows:
+                break
+            if authors is not None:
+                rows = with_authors(rows, authors)
+            items = [json.dumps(to_dict(row), ensure_ascii=False) for row in rows]
+            if fmt == 'ndjson':
+                yield ('\n'.join(items) + '\n').encode()
+            else:
+                yield (('' if first else ',') + ','.join(items)).encode()
+            first = False
+        if fmt == 'array':
+            yield b']\n'
+    # stream_with_context で最後まで送り終えるまでDB接続を返却しない
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def rows_response(c, to_dict, authors=None):
+    # authors: 投稿者のuidの列番号。指定すると行の末尾に名前とアイコンを足してから to_dict に渡す
+    fmt = stream_format()
+    if fmt:
+        return stream_rows(c, to_dict, fmt, authors)
+    rows = c.fetchall()
+    if authors is not None:
+        rows = with_authors(rows, authors)
+    return jsonify([to_dict(row) for row in rows])
 
 @app.route('/')
 def home():
@@ -123,11 +1973,10 @@ def rooms():
 
 @app.route('/room/<int:room_id>')
 def room(room_id):
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT name FROM rooms WHERE id = ?", (room_id,))
     row = c.fetchone()
-    conn.close()
     room_name = row[0] if row else "不明な部屋"
     return render_template('room.html', room_id=room_id, room_name=room_name)
 
@@ -165,106 +2014,357 @@ def api_username():
     if not user:
         return jsonify({'error': '認証エラー'}), 401
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     c.execute("INSERT OR REPLACE INTO users (uid, username) VALUES (?, ?)", (uid, username))
     conn.commit()
-    conn.close()
+    user_cache.invalidate(uid)
+    # 投稿一覧にユーザー名が入っているので消す
+    response_cache.invalidate('posts:*', 'match_idols')
     return jsonify({'result': 'ok'})
 
 @app.route('/api/username_check', methods=['POST'])
 def api_username_check():
     data = request.get_json()
     uid = data.get('uid')
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE uid = ?", (uid,))
     row = c.fetchone()
-    conn.close()
     return jsonify({'need_username': not bool(row and row[0])})
 
+# 部屋一覧の1ページあたりの件数
+ROOMS_PAGE_SIZE = 30
+ROOMS_MAX_PAGE_SIZE = 100
+
 @app.route('/api/rooms', methods=['GET', 'POST'])
+@cached_response('rooms')
 def api_rooms():
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'GET':
-        c.execute("SELECT id, name FROM rooms")
-        rooms = [{'id': row[0], 'name': row[1]} for row in c.fetchall()]
-        conn.close()
-        return jsonify(rooms)
+        # 最近投稿のあった順。cursor は前のページの最後の部屋の "最後の投稿id:部屋id"
+        # q: 部屋名の部分一致 / name: 部屋名の完全一致
+        limit = request.args.get('limit', ROOMS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, ROOMS_MAX_PAGE_SIZE))
+        where, params = [], []
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                last_post_id, room_id = (int(v) for v in cursor.split(':'))
+            except ValueError:
+                return jsonify({'error': 'パラメータが不正です'}), 400
+            where.append("(s.last_post_id, s.room_id) < (?, ?)")
+            params += [last_post_id, room_id]
+        if request.args.get('q'):
+            where.append("r.name LIKE ? ESCAPE '\\'")
+            params.append(like_pattern(request.args['q']))
+        if request.args.get('name'):
+            where.append("r.name = ?")
+            params.append(request.args['name'])
+        c.execute(f"""
+            SELECT s.room_id, r.name, s.post_count, s.last_post_id, s.last_post_at, s.last_uid
+            FROM room_stats s
+            JOIN rooms r ON r.id = s.room_id
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY s.last_post_id DESC, s.room_id DESC
+            LIMIT ?
+        """, params + [limit])
+        rows = with_authors(c.fetchall(), 5)
+        return jsonify({
+            'rooms': [{
+                'id': row[0],
+                'name': row[1],
+                'post_count': row[2],
+                'last_post_id': row[3] or None,
+                'last_post_at': row[4],
+                'last_uid': row[5],
+                'last_username': row[6],
+            } for row in rows],
+            'cursor': f'{rows[-1][3]}:{rows[-1][0]}' if len(rows) == limit else None,
+        })
 
     data = request.get_json()
     name = data.get('name')
     creator_uid = data.get('creator_uid')  # 追加
     if not name or not creator_uid:
-        conn.close()
         return jsonify({'error': '部屋名と作成者が必要です'}), 400
     try:
         c.execute("INSERT INTO rooms (name, creator_uid) VALUES (?, ?)", (name, creator_uid))
         conn.commit()
+        response_cache.invalidate('rooms')
         new_id = c.lastrowid
-        conn.close()
         return jsonify({'id': new_id, 'name': name})
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': '同じ名前の部屋が既に存在します'}), 400
 
+# チャット投稿の1ページあたりの件数
+POSTS_PAGE_SIZE = 50
+POSTS_MAX_PAGE_SIZE = 200
+
+def posts_page_limit():
+    limit = request.args.get('limit', POSTS_PAGE_SIZE, type=int)
+    return max(1, min(limit, POSTS_MAX_PAGE_SIZE))
+
+def post_dict(row):
+    # row: id, uid, content + with_authors の (username, icon_url)
+    return {
+        'id': row[0],
+        'uid': row[1],
+        'username': row[3],
+        'icon_url': row[4],
+        'content': row[2],
+    }
+
+def select_posts(c, room_id, limit, before_id=None, since_id=None):
+    # before_id: それより古い投稿を1ページ分 / since_id: それより新しい投稿だけ
+    if since_id is not None:
+        # 取りこぼさないよう古い方から詰めて返す（件数がlimitならクライアントが続きを取る）
+        c.execute("""
+            SELECT * FROM (
+                SELECT id, uid, content
+                FROM posts
+                WHERE room_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ) ORDER BY id DESC
+        """, (room_id, since_id, limit))
+    elif before_id is not None:
+        c.execute("""
+            SELECT id, uid, content
+            FROM posts
+            WHERE room_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (room_id, before_id, limit))
+    else:
+        c.execute("""
+            SELECT id, uid, content
+            FROM posts
+            WHERE room_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (room_id, limit))
+
 @app.route('/api/posts', methods=['GET', 'POST'])
+@rate_limited('post')
+@cached_response(posts_namespace)
 def api_posts():
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'GET':
-        room_id = request.args.get('room_id')
+        room_id = request.args.get('room_id', type=int)
         if not room_id:
-            conn.close()
             return jsonify([])
-        # 部屋作成者のuidを取得
-        c.execute("SELECT creator_uid FROM rooms WHERE id = ?", (room_id,))
-        room_row = c.fetchone()
-        creator_uid = room_row[0] if room_row else None
-
-        c.execute("""
-            SELECT posts.uid, users.username, users.icon_url, posts.content
-            FROM posts
-            LEFT JOIN users ON posts.uid = users.uid
-            WHERE posts.room_id = ?
-            ORDER BY posts.id DESC
-        """, (room_id,))
-        posts = [
-            {
-                'uid': row[0],
-                'username': row[1],
-                'icon_url': row[2],
-                'content': row[3],
-                'creator_uid': creator_uid  # 追加
-            } for row in c.fetchall()
-        ]
-        conn.close()
-        return jsonify(posts)
+        c.execute("SELECT 1 FROM rooms WHERE id = ? AND deleted = 1", (room_id,))
+        if c.fetchone():
+            # 削除中の部屋
+            return jsonify([])
+        # 部屋の作成者は投稿ごとには返さない（/api/rooms/<id>/bootstrap の room に入っている）
+        posts_c = get_posts_db(room_id).cursor()
+        select_posts(posts_c, room_id, posts_page_limit(), request.args.get('before_id', type=int),
+                     request.args.get('since_id', type=int))
+        return rows_response(posts_c, post_dict, authors=1)
 
     data = request.get_json()
     id_token = data.get('idToken')
     content = data.get('content')
     room_id = data.get('room_id')
     if not (id_token and content and room_id):
-        conn.close()
+        return jsonify({'error': 'idToken, content, room_idが必要です'}), 400
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
         return jsonify({'error': 'idToken, content, room_idが必要です'}), 400
 
     user = verify_token(id_token)
     if not user:
-        conn.close()
         return jsonify({'error': '認証失敗'}), 401
+    c.execute("SELECT 1 FROM rooms WHERE id = ? AND deleted = 1", (room_id,))
+    if c.fetchone():
+        return jsonify({'error': '部屋が削除されています'}), 404
 
-    c.execute("INSERT INTO posts (room_id, uid, content) VALUES (?, ?, ?)",
-              (room_id, user['uid'], content))
-    conn.commit()
-    conn.close()
-    return jsonify({'success': True})
+    if post_shards.enabled:
+        # 投稿はシャードに書き、部屋の活動とポイントは本体DBにまとめて書く（本体の書き込みロックを待たない）
+        shard = post_shards.shard_of(room_id)
+        post_id = post_shards.insert(get_shard_db(shard), shard, room_id, user['uid'], content)
+        counter_buffer.add_post(room_id, post_id, user['uid'])
+    else:
+        c.execute("INSERT INTO posts (room_id, uid, content) VALUES (?, ?, ?)",
+                  (room_id, user['uid'], content))
+        post_id = c.lastrowid
+        award_points(c, user['uid'], POINTS_CHAT_POST, 'chat_post')
+        conn.commit()
+    response_cache.invalidate(f'posts:{room_id}', 'rooms')
+    # ストリーム購読者へ配信（購読者側はDBを読まない）
+    if room_hub.has_subscribers(room_id):
+        author = user_cache.get(user['uid'])
+        room_hub.publish(room_id, post_dict((post_id, user['uid'], content) + author[:2]))
+    return jsonify({'success': True, 'id': post_id})
+
+# 部屋チャットのリアルタイム配信（Server-Sent Events）
+# 購読者はワーカープロセス内のハブに登録されるので、gunicornはgeventワーカー1つで動かす
+# （Procfileで --workers 1 を指定。WEB_CONCURRENCY でワーカーを増やすと、別ワーカー経由の投稿が届かない）
+app.config['SSE_QUEUE_SIZE'] = int(os.getenv("SSE_QUEUE_SIZE", "100"))
+app.config['SSE_HEARTBEAT'] = float(os.getenv("SSE_HEARTBEAT", "15"))
+app.config['SSE_RESUME_LIMIT'] = int(os.getenv("SSE_RESUME_LIMIT", "500"))
+
+class Subscriber:
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.evicted = False
+
+class RoomHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.stats = {'published': 0, 'delivered': 0, 'evicted': 0,
+                      'fanout_time': 0.0, 'delivery_count': 0, 'delivery_latency': 0.0}
+
+    def subscribe(self, room_id):
+        sub = Subscriber(app.config['SSE_QUEUE_SIZE'])
+        with self.lock:
+            self.rooms.setdefault(room_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, room_id, sub):
+        with self.lock:
+            subs = self.rooms.get(room_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self.rooms[room_id]
+
+    def has_subscribers(self, room_id):
+        try:
+            return int(room_id) in self.rooms
+        except (TypeError, ValueError):
+            return False
+
+    def publish(self, room_id, post):
+        start = time.perf_counter()
+        event = (post['id'], json.dumps(post, ensure_ascii=False), start)
+        with self.lock:
+            subs = list(self.rooms.get(int(room_id), ()))
+        delivered = 0
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                # 読むのが遅いクライアントは切断し、Last-Event-IDで再接続させる
+                self._evict(int(room_id), sub)
+        with self.lock:
+            self.stats['published'] += 1
+            self.stats['delivered'] += delivered
+            self.stats['fanout_time'] += time.perf_counter() - start
+
+    def _evict(self, room_id, sub):
+        sub.evicted = True
+        self.unsubscribe(room_id, sub)
+        while True:
+            try:
+                sub.queue.get_nowait()
+            except queue.Empty:
+                break
+        sub.queue.put_nowait(None)
+        with self.lock:
+            self.stats['evicted'] += 1
+
+    def record_delivery(self, published_at):
+        with self.lock:
+            self.stats['delivery_count'] += 1
+            self.stats['delivery_latency'] += time.perf_counter() - published_at
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['rooms'] = len(self.rooms)
+            data['clients'] = sum(len(s) for s in self.rooms.values())
+        data['avg_fanout_ms'] = data['fanout_time'] * 1000 / data['published'] if data['published'] else 0.0
+        data['avg_delivery_ms'] = data['delivery_latency'] * 1000 / data['delivery_count'] if data['delivery_count'] else 0.0
+        return data
+
+room_hub = RoomHub()
+
+def sse_event(post_id, payload):
+    return f"id: {post_id}\ndata: {payload}\n\n"
+
+def load_missed_posts(room_id, last_id):
+    # 再接続時: Last-Event-ID より後の投稿をpostsテーブルから読み直す
+    missed = []
+    if last_id is None:
+        return missed
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM rooms WHERE id = ? AND deleted = 1", (room_id,))
+    if c.fetchone():
+        return missed
+    c = get_posts_db(room_id).cursor()
+    c.execute("""
+        SELECT id, uid, content
+        FROM posts
+        WHERE room_id = ? AND id > ?
+        ORDER BY id ASC
+        LIMIT ?
+    """, (room_id, last_id, app.config['SSE_RESUME_LIMIT']))
+    for row in with_authors(c.fetchall(), 1):
+        missed.append((row[0], json.dumps(post_dict(row), ensure_ascii=False)))
+    return missed
+
+@app.route('/api/rooms/<int:room_id>/stream')
+def room_stream(room_id):
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_id', type=int)
+    # 取りこぼしを防ぐため、先に購読してから過去分を読む
+    sub = room_hub.subscribe(room_id)
+    try:
+        missed = load_missed_posts(room_id, last_id)
+    except Exception:
+        room_hub.unsubscribe(room_id, sub)
+        raise
+    heartbeat = app.config['SSE_HEARTBEAT']
+
+    def generate():
+        sent_id = last_id or 0
+        try:
+            yield "retry: 3000\n\n"
+            for post_id, payload in missed:
+                sent_id = post_id
+                yield sse_event(post_id, payload)
+            while True:
+                try:
+                    event = sub.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    break
+                post_id, payload, published_at = event
+                if post_id <= sent_id:
+                    continue
+                sent_id = post_id
+                room_hub.record_delivery(published_at)
+                yield sse_event(post_id, payload)
+        finally:
+            room_hub.unsubscribe(room_id, sub)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/api/stream_stats')
+@stats_endpoint
+def api_stream_stats():
+    return jsonify(room_hub.snapshot())
 
 # プロフィール画像アップロードAPI
 @app.route('/api/upload_icon', methods=['POST'])
+@upload_limit('icons')
 def upload_icon():
     id_token = request.form.get('idToken')
     user = verify_token(id_token)
@@ -272,23 +2372,24 @@ def upload_icon():
         return jsonify({'error': '認証エラー'}), 401
     if 'icon' not in request.files:
         return jsonify({'error': 'ファイルがありません'}), 400
-    file = request.files['icon']
-    if file.filename == '':
-        return jsonify({'error': 'ファイル名がありません'}), 400
-    if file and allowed_file(file.filename):
-        filename = secure_filename(user['uid'] + '_' + file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        icon_url = url_for('static', filename='icons/' + filename)
-        # DBに保存
-        conn = sqlite3.connect("idolapp.db")
-        c = conn.cursor()
-        c.execute("UPDATE users SET icon_url = ? WHERE uid = ?", (icon_url, user['uid']))
-        conn.commit()
-        conn.close()
-        return jsonify({'icon_url': icon_url})
-    else:
-        return jsonify({'error': '許可されていないファイル形式です'}), 400
+    file = request.files['icon']
+    if file.filename == '':
+        return jsonify({'error': 'ファイル名がありません'}), 400
+    try:
+        variants = process_upload(file, 'icons')
+    except Exception as e:
+        return image_error(e)
+    # 一覧では小さい方、プロフィールでは大きい方を使う
+    icon_url = variants['avatar64']
+    # DBに保存
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("UPDATE users SET icon_url = ?, icon_variants = ? WHERE uid = ?",
+              (icon_url, json.dumps(variants), user['uid']))
+    conn.commit()
+    user_cache.invalidate(user['uid'])
+    response_cache.invalidate('posts:*')
+    return jsonify({'icon_url': icon_url, 'icon_variants': variants})
 
 # プロフィール取得API（GET）
 @app.route('/api/profile', methods=['GET'])
@@ -298,21 +2399,24 @@ def api_profile_get():
     if not user:
         return jsonify({'error': '認証エラー'}), 401
 
-    uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
-    c.execute("SELECT icon_url, username, point, profile FROM users WHERE uid=?", (uid,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    conn = get_db()
+    profile = load_profile(conn.cursor(), user['uid'])
+    if not profile:
         return jsonify({'error': 'ユーザー情報がありません'}), 404
+    return jsonify(profile)
 
-    return jsonify({
+def load_profile(c, uid):
+    c.execute("SELECT icon_url, username, point, profile, icon_variants FROM users WHERE uid=?", (uid,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return {
         'icon_url': row[0],
         'username': row[1],
         'point': row[2],
-        'profile': row[3]
-    })
+        'profile': row[3],
+        'icon_variants': json.loads(row[4]) if row[4] else None
+    }
 
 # プロフィール更新API（POST）
 @app.route('/api/profile', methods=['POST'])
@@ -325,14 +2429,16 @@ def api_profile_post():
     if not user:
         return jsonify({'error': '認証エラー'}), 401
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     if username is not None:
         c.execute("UPDATE users SET profile = ?, username = ? WHERE uid = ?", (profile, username, uid))
     else:
         c.execute("UPDATE users SET profile = ? WHERE uid = ?", (profile, uid))
     conn.commit()
-    conn.close()
+    if username is not None:
+        user_cache.invalidate(uid)
+        response_cache.invalidate('posts:*', 'match_idols')
     return jsonify({'result': 'ok'})
 
 
@@ -345,11 +2451,10 @@ def api_profile():
         return jsonify({'error': '認証エラー'}), 401
 
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT icon_url, username, point, bio FROM users WHERE uid=?", (uid,))
     row = c.fetchone()
-    conn.close()
     if not row:
         return jsonify({'error': 'ユーザー情報がありません'}), 404
 
@@ -360,6 +2465,32 @@ def api_profile():
         'bio': row[3]
     })
 
+# 部屋ページを開いたときに必要なもの（部屋の情報、最新の投稿1ページ、自分のプロフィール）をまとめて返す
+# Authorization: Bearer <idToken> がなければ profile は null
+@app.route('/api/rooms/<int:room_id>/bootstrap')
+def room_bootstrap(room_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT r.id, r.name, r.creator_uid, s.post_count, s.last_post_id
+        FROM rooms r
+        JOIN room_stats s ON s.room_id = r.id
+        WHERE r.id = ?
+    """, (room_id,))
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': '部屋が見つかりません'}), 404
+    room = {'id': row[0], 'name': row[1], 'creator_uid': row[2], 'post_count': row[3], 'last_post_id': row[4] or None}
+    posts_c = get_posts_db(room_id).cursor()
+    select_posts(posts_c, room_id, posts_page_limit())
+    posts = [post_dict(r) for r in with_authors(posts_c.fetchall(), 1)]
+    user = verify_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
+    return jsonify({
+        'room': room,
+        'posts': posts,
+        'profile': load_profile(c, user['uid']) if user else None,
+    })
+
 @app.route('/api/rooms/<int:room_id>', methods=['DELETE'])
 def delete_room(room_id):
     data = request.get_json()
@@ -368,33 +2499,268 @@ def delete_room(room_id):
     if not user:
         return jsonify({'error': '認証エラー'}), 401
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     # 部屋の作成者か確認
     c.execute("SELECT creator_uid FROM rooms WHERE id = ?", (room_id,))
     row = c.fetchone()
     if not row or row[0] != uid:
-        conn.close()
         return jsonify({'error': '削除権限がありません'}), 403
-    # 部屋と関連投稿を削除
-    c.execute("DELETE FROM posts WHERE room_id = ?", (room_id,))
-    c.execute("DELETE FROM rooms WHERE id = ?", (room_id,))
+    # すぐに一覧から隠し、投稿はバックグラウンドで少しずつ消す
+    c.execute("UPDATE rooms SET deleted = 1 WHERE id = ?", (room_id,))
+    job_id = delete_jobs.enqueue(c, 'room', room_id)
+    conn.commit()
+    response_cache.invalidate('rooms', f'posts:{room_id}')
+    delete_jobs.wake()
+    return jsonify({'result': 'ok', 'job_id': job_id})
+
+# 週間ランキング
+# weekly_scores が正。上位と一覧は (week_start, points DESC, uid) の索引から引く（プロセス内には持たない）
+# 一覧のGETは応答キャッシュから返す。ポイントの加算では無効化しない（投稿やいいねのたびに消えるので）
+# ため、RESPONSE_CACHE_TTL 秒までは古い。週の締めで無効化する。自分の順位は /api/ranking/me で毎回引く
+app.config['RANKING_PAGE_SIZE'] = 20
+app.config['RANKING_KEEP_WEEKS'] = int(os.getenv("RANKING_KEEP_WEEKS", "8"))
+app.config['CHAMPION_KEEP_WEEKS'] = int(os.getenv("CHAMPION_KEEP_WEEKS", "8"))
+POINTS_CHAT_POST = 1
+POINTS_MATCH_POST = 3
+POINTS_LIKE_RECEIVED = 1
+
+# 順位用のポイントの分布（weekly_score_buckets）。幅 2^level の区間ごとの人数を持つ
+# level = RANK_LEVELS の区間は1つだけで、その週の全体の人数になる
+# 自分より上の人数は区間を RANK_LEVELS + 2 個まで足せば出るので、人数が増えても O(log n)
+# 同点は同じ順位。ポイントは 2^RANK_LEVELS - 1 で頭打ちとして数える（週にそこまで貯まることはない）
+RANK_LEVELS = 32
+RANK_MAX_POINTS = (1 << RANK_LEVELS) - 1
+
+def bucket_node(level, bucket):
+    return (bucket << 6) | level
+
+def rank_node(level, points):
+    return bucket_node(level, min(max(points, 0), RANK_MAX_POINTS) >> level)
+
+def move_rank_buckets(c, week, old, new):
+    # old が None なら今週はじめてのポイント。上の区間ほど動かないので、同じ区間になったらそこまで
+    changes = []
+    for level in range(RANK_LEVELS + 1):
+        node = rank_node(level, new)
+        if old is not None:
+            old_node = rank_node(level, old)
+            if old_node == node:
+                break
+            changes.append((week, old_node, -1))
+        changes.append((week, node, 1))
+    c.executemany("""
+        INSERT INTO weekly_score_buckets (week_start, node, users) VALUES (?, ?, ?)
+        ON CONFLICT (week_start, node) DO UPDATE SET users = users + excluded.users
+    """, changes)
+
+def current_week(today=None):
+    today = today or datetime.date.today()
+    return (today - datetime.timedelta(days=today.weekday())).isoformat()
+
+def award_points(c, uid, points, reason):
+    # 呼び出し側のトランザクション内で使う（commitは呼び出し側）
+    week = current_week()
+    c.execute("INSERT INTO point_ledger (uid, week_start, points, reason) VALUES (?, ?, ?, ?)",
+              (uid, week, points, reason))
+    c.execute("SELECT points FROM weekly_scores WHERE week_start = ? AND uid = ?", (week, uid))
+    row = c.fetchone()
+    c.execute("""
+        INSERT INTO weekly_scores (week_start, uid, points) VALUES (?, ?, ?)
+        ON CONFLICT (week_start, uid) DO UPDATE SET points = points + excluded.points
+    """, (week, uid, points))
+    old = row[0] if row else None
+    move_rank_buckets(c, week, old, (old or 0) + points)
+    c.execute("UPDATE users SET point = COALESCE(point, 0) + ? WHERE uid = ?", (points, uid))
+
+class Leaderboard:
+    # 並びは (ポイントの多い順, uid) で、同点はuidの順（順位は同じ）
+    def top(self, c):
+        c.execute("""
+            SELECT uid FROM weekly_scores WHERE week_start = ?
+            ORDER BY points DESC, uid LIMIT 1
+        """, (current_week(),))
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def _users(self, c, week, nodes):
+        marks = ','.join('?' * len(nodes))
+        c.execute(f"SELECT node, users FROM weekly_score_buckets WHERE week_start = ? AND node IN ({marks})",
+                  (week, *nodes))
+        return dict(c.fetchall())
+
+    def total(self, c, week):
+        return self._users(c, week, [bucket_node(RANK_LEVELS, 0)]).get(bucket_node(RANK_LEVELS, 0), 0)
+
+    def count_above(self, c, week, points):
+        # points より多い人数 = 全体 - (points + 1 未満の人数)。未満の方は points + 1 の立っているbitの区間の和
+        limit = min(max(points, 0), RANK_MAX_POINTS) + 1
+        below = [bucket_node(level, (limit >> level) - 1) for level in range(RANK_LEVELS + 1) if limit >> level & 1]
+        users = self._users(c, week, below + [bucket_node(RANK_LEVELS, 0)])
+        return users.get(bucket_node(RANK_LEVELS, 0), 0) - sum(users.get(node, 0) for node in below)
+
+    def seek(self, c, week, offset):
+        # 上から offset 番目（0始まり）の人のポイントと、それより多い人数。区間を上からたどる
+        above = 0
+        bucket = 0
+        for level in range(RANK_LEVELS - 1, -1, -1):
+            right = bucket * 2 + 1
+            users = self._users(c, week, [bucket_node(level, right)]).get(bucket_node(level, right), 0)
+            if above + users > offset:
+                bucket = right
+            else:
+                above += users
+                bucket = right - 1
+        return bucket, above
+
+    def page(self, c, week, offset, limit):
+        total = self.total(c, week)
+        if offset >= total:
+            return [], total
+        # OFFSET で読み飛ばすのは同点の人の分だけ
+        points, above = self.seek(c, week, offset)
+        c.execute("""
+            SELECT uid, points FROM weekly_scores WHERE week_start = ? AND points <= ?
+            ORDER BY points DESC, uid LIMIT ? OFFSET ?
+        """, (week, points, limit, offset - above))
+        entries = []
+        rank = above + 1
+        for i, (uid, p) in enumerate(c.fetchall()):
+            if i and p != entries[-1][2]:
+                rank = offset + i + 1
+            entries.append((rank, uid, p))
+        return entries, total
+
+    def rank(self, c, week, uid):
+        c.execute("SELECT points FROM weekly_scores WHERE week_start = ? AND uid = ?", (week, uid))
+        row = c.fetchone()
+        if row is None:
+            return None, 0
+        return self.count_above(c, week, row[0]) + 1, row[0]
+
+leaderboard = Leaderboard()
+
+@app.route('/api/ranking')
+@cached_response('ranking')
+def api_ranking():
+    limit = request.args.get('limit', app.config['RANKING_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, 100))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    conn = get_db()
+    c = conn.cursor()
+    week = current_week()
+    entries, total = leaderboard.page(c, week, offset, limit)
+    users = user_cache.get_many([e[1] for e in entries]) if entries else {}
+    ranking = [
+        {
+            'rank': rank,
+            'uid': uid,
+            'username': users[uid][0],
+            'level': users[uid][3] if users[uid][3] is not None else 1,
+            'point': points
+        } for rank, uid, points in entries
+    ]
+    return jsonify({
+        'week_start': week,
+        'total': total,
+        'offset': offset,
+        'ranking': ranking,
+    })
+
+# 自分の順位（ユーザーごとに違うのでキャッシュしない）
+@app.route('/api/ranking/me')
+def api_ranking_me():
+    id_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    user = verify_token(id_token) if id_token else None
+    if not user:
+        return jsonify({'error': '認証エラー'}), 401
+    conn = get_db()
+    c = conn.cursor()
+    week = current_week()
+    rank, points = leaderboard.rank(c, week, user['uid'])
+    return jsonify({
+        'week_start': week,
+        'me': {'uid': user['uid'], 'rank': rank, 'point': points}
+    })
+
+def rollover_week(conn, week=None):
+    # 先週の1位を記録して、古い週の集計を消す（何度実行しても同じ結果）
+    c = conn.cursor()
+    this_week = datetime.date.fromisoformat(week or current_week())
+    last_week = (this_week - datetime.timedelta(days=7)).isoformat()
+    c.execute("""
+        INSERT OR IGNORE INTO weekly_champions (week_start, uid, points)
+        SELECT week_start, uid, points FROM weekly_scores
+        WHERE week_start = ?
+        ORDER BY points DESC, uid
+        LIMIT 1
+    """, (last_week,))
+    keep_from = (this_week - datetime.timedelta(weeks=app.config['RANKING_KEEP_WEEKS'])).isoformat()
+    c.execute("DELETE FROM weekly_scores WHERE week_start < ?", (keep_from,))
+    c.execute("DELETE FROM weekly_score_buckets WHERE week_start < ?", (keep_from,))
+    c.execute("DELETE FROM point_ledger WHERE week_start < ?", (keep_from,))
+    champion_from = (this_week - datetime.timedelta(weeks=app.config['CHAMPION_KEEP_WEEKS'])).isoformat()
+    files = prune_champion_images(c, champion_from)
     conn.commit()
+    remove_champion_files(c, files)
+    conn.commit()
+    response_cache.invalidate('champion', 'ranking')
+    return last_week
+
+def rollover_loop():
+    while True:
+        # 次の月曜0時まで寝てから締める
+        now = datetime.datetime.now()
+        next_week = datetime.datetime.combine(
+            datetime.date.fromisoformat(current_week()) + datetime.timedelta(days=7),
+            datetime.time())
+        time.sleep(max(1, (next_week - now).total_seconds() + 1))
+        try:
+            conn = db_pool.acquire()
+            try:
+                rollover_week(conn)
+            finally:
+                db_pool.release(conn)
+        except Exception:
+            app.logger.exception('週次の締め処理に失敗しました')
+
+rollover_started_pid = None
+
+@app.before_request
+def start_rollover_scheduler():
+    global rollover_started_pid
+    if rollover_started_pid != os.getpid():
+        rollover_started_pid = os.getpid()
+        threading.Thread(target=rollover_loop, daemon=True).start()
+
+@app.cli.command('rollover-week')
+def rollover_week_command():
+    # cronなどから手動で締めるとき: flask --app app rollover-week
+    conn = sqlite3.connect(DB_PATH)
+    print('closed week', rollover_week(conn))
     conn.close()
-    return jsonify({'result': 'ok'})
 
 @app.route('/champion')
 def mission():
     return render_template('champion.html')
 
 
+# チャンピオン画像（champion_images テーブルが正。GETは応答キャッシュから返す）
 @app.route('/api/champion_image', methods=['GET', 'POST'])
+@upload_limit('champion_images')
+@cached_response('champion')
 def champion_image():
     if request.method == 'GET':
-        # 画像一覧を返す（1枚だけの場合は最新1件だけ返すなど）
-        files = os.listdir('static/champion_images')
-        urls = [url_for('static', filename=f'champion_images/{f}') for f in files if f.lower().endswith(('.png','.jpg','.jpeg','.gif'))]
-        return jsonify(urls)
+        # 今週の最新の1枚（今週まだなければ直近の1枚）をリストで返す
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("""
+            SELECT url FROM champion_images
+            WHERE week_start <= ?
+            ORDER BY week_start DESC, id DESC
+            LIMIT 1
+        """, (current_week(),))
+        return jsonify([row[0] for row in c.fetchall()])
     else:
         id_token = request.form.get('idToken')
         user = verify_token(id_token)
@@ -404,94 +2770,683 @@ def champion_image():
         uid = user['uid']
 
         # 今週のランキング1位のuidを取得
-        conn = sqlite3.connect("idolapp.db")
+        conn = get_db()
         c = conn.cursor()
-        # 例：今週の開始日を計算
-        today = datetime.date.today()
-        week_start = today - datetime.timedelta(days=today.weekday())
-        c.execute("""
-            SELECT uid FROM users
-            ORDER BY level DESC, point DESC
-            LIMIT 1
-        """)
-        row = c.fetchone()
-        conn.close()
-        if not row or row[0] != uid:
+        if leaderboard.top(c) != uid:
             return jsonify({'error': '今週のランキング1位のみアップロードできます'}), 403
 
         file = request.files.get('image')
         if not file:
             return jsonify({'error': '画像がありません'}), 400
-        filename = secure_filename(file.filename)
-        save_dir = os.path.join('static', 'champion_images')
-        os.makedirs(save_dir, exist_ok=True)
-        save_path = os.path.join(save_dir, filename)
-        file.save(save_path)
-        url = url_for('static', filename=f'champion_images/{filename}')
-        return jsonify({'url': url})
+        try:
+            digest, variants, (width, height), _ = upload_image(file, 'champion_images')
+        except Exception as e:
+            return image_error(e)
+        c.execute("""
+            INSERT INTO champion_images (week_start, uid, hash, width, height, url, variants)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (current_week(), uid, digest, width, height, variants['card'], json.dumps(variants)))
+        conn.commit()
+        response_cache.invalidate('champion')
+        return jsonify({'url': variants['card'], 'variants': variants})
+
+def prune_champion_images(c, keep_from):
+    # keep_from より前の週の行を消し、使っていたファイルのURLを返す（ファイルはcommit後に消す）
+    c.execute("SELECT url, variants FROM champion_images WHERE week_start < ?", (keep_from,))
+    files = {}
+    for url, variants in c.fetchall():
+        files.setdefault(url, set()).update(json.loads(variants).values() if variants else [url])
+    c.execute("DELETE FROM champion_images WHERE week_start < ?", (keep_from,))
+    return files
+
+def remove_champion_files(c, files):
+    # 同じ画像を別の週にも上げていれば残す。uploads の行も消すので呼び出し側でcommitする
+    static_prefix = app.static_url_path + '/'
+    image_dir = os.path.join(app.static_folder, 'champion_images') + os.sep
+    unused = []
+    for url, urls in files.items():
+        c.execute("SELECT 1 FROM champion_images WHERE url = ? LIMIT 1", (url,))
+        if c.fetchone():
+            continue
+        unused.append(url)
+        for u in urls:
+            path = os.path.normpath(os.path.join(app.static_folder, u[len(static_prefix):]))
+            if u.startswith(static_prefix) and path.startswith(image_dir):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    forget_uploads(c, 'champion_images', unused)
 
 @app.route('/landing')
 def landing():
     return render_template('landing.html')
 
+# リアクション・いいねのカウンタはメモリに貯めてまとめて書き込む（write-behind）
+# COUNTER_DURABILITY=sync にするとリクエストごとに書き込む（落ちても消えない）
+app.config['COUNTER_DURABILITY'] = os.getenv("COUNTER_DURABILITY", "batched")
+app.config['COUNTER_FLUSH_MS'] = int(os.getenv("COUNTER_FLUSH_MS", "200"))
+app.config['COUNTER_FLUSH_EVENTS'] = int(os.getenv("COUNTER_FLUSH_EVENTS", "500"))
+REACTION_COLUMNS = {'like': 'likes', 'heart': 'hearts'}
+
+class CounterBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.reactions = {}
+        self.likes = []
+        # シャードに書いたチャット投稿 (room_id, post_id, uid)。部屋の活動とポイントを本体DBに反映する
+        self.posts = []
+        # まだ書き込んでいないいいねの (post_id, uid)
+        self.like_keys = set()
+        self.pending = 0
+        self.pid = None
+        self.stats = {'events': 0, 'flushes': 0, 'flushed_events': 0, 'transactions': 0,
+                      'flush_time': 0.0, 'max_batch': 0, 'errors': 0}
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.reactions = {}
+            self.likes = []
+            self.like_keys = set()
+            self.posts = []
+            self.pending = 0
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            self.wakeup.wait(app.config['COUNTER_FLUSH_MS'] / 1000)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('カウンタの書き込みに失敗しました')
+
+    def _added(self):
+        self.stats['events'] += 1
+        self.pending += 1
+        return self.pending >= app.config['COUNTER_FLUSH_EVENTS']
+
+    def _after_add(self, full):
+        if app.config['COUNTER_DURABILITY'] == 'sync':
+            self.flush()
+        elif full:
+            self.wakeup.set()
+
+    def add_reaction(self, post_id, kind):
+        self._ensure_started()
+        with self.lock:
+            key = (post_id, kind)
+            self.reactions[key] = self.reactions.get(key, 0) + 1
+            full = self._added()
+        self._after_add(full)
+
+    def add_like(self, post_id, uid):
+        # 既にいいね済みなら False。書き込み済みは match_post_likes の一意キーで、未書き込みはバッファで見る
+        # 別のワーカーと同時にいいねされても、書き込み時の INSERT OR IGNORE で1回だけ数える
+        self._ensure_started()
+        c = get_db().cursor()
+        c.execute("SELECT 1 FROM match_post_likes WHERE post_id = ? AND user_uid = ?", (post_id, uid))
+        if c.fetchone():
+            return False
+        with self.lock:
+            if (post_id, uid) in self.like_keys:
+                return False
+            self.like_keys.add((post_id, uid))
+            self.likes.append((post_id, uid))
+            full = self._added()
+        self._after_add(full)
+        return True
+
+    def add_post(self, room_id, post_id, uid):
+        self._ensure_started()
+        with self.lock:
+            self.posts.append((room_id, post_id, uid))
+            full = self._added()
+        self._after_add(full)
+
+    def pending_likes(self, uid):
+        # まだ書き込んでいないいいね
+        with self.lock:
+            return {post_id for post_id, u in self.likes if u == uid}
+
+    def _requeue(self, reactions, likes=(), posts=()):
+        # 失敗した分は戻して次回にまとめる
+        with self.lock:
+            for key, n in reactions.items():
+                self.reactions[key] = self.reactions.get(key, 0) + n
+            self.likes = list(likes) + self.likes
+            self.like_keys.update(likes)
+            self.posts = list(posts) + self.posts
+            self.pending += len(reactions) + len(likes) + len(posts)
+            self.stats['errors'] += 1
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                reactions, likes, posts = self.reactions, self.likes, self.posts
+                self.reactions, self.likes, self.posts = {}, [], []
+                self.like_keys = set()
+                self.pending = 0
+            if not reactions and not likes and not posts:
+                return 0
+            start = time.perf_counter()
+            # チャットのリアクションは、シャードを使うときはシャードごとに書く
+            shard_reactions = {}
+            if post_shards.enabled:
+                reactions, shard_reactions = {}, reactions
+            conn = db_pool.acquire()
+            try:
+                self._write(conn, reactions, likes, posts)
+            except Exception:
+                conn.rollback()
+                # シャードの分もまだ書いていないので一緒に戻す
+                self._requeue({**reactions, **shard_reactions}, likes, posts)
+                raise
+            finally:
+                db_pool.release(conn)
+            if shard_reactions:
+                failed = post_shards.add_reactions(shard_reactions)
+                if failed:
+                    self._requeue(failed)
+            count = sum(reactions.values()) + sum(shard_reactions.values()) + len(likes) + len(posts)
+            with self.lock:
+                self.stats['flushes'] += 1
+                self.stats['transactions'] += 1
+                self.stats['flushed_events'] += count
+                self.stats['flush_time'] += time.perf_counter() - start
+                self.stats['max_batch'] = max(self.stats['max_batch'], count)
+            return count
+
+    def _write(self, conn, reactions, likes, posts):
+        # 1トランザクションで書き込む
+        c = conn.cursor()
+        for kind, column in REACTION_COLUMNS.items():
+            rows = [(n, post_id) for (post_id, k), n in reactions.items() if k == kind]
+            if rows:
+                c.executemany(f"UPDATE posts SET {column} = COALESCE({column}, 0) + ? WHERE id = ?", rows)
+        added = {}
+        for post_id, uid in likes:
+            c.execute("INSERT OR IGNORE INTO match_post_likes (post_id, user_uid) VALUES (?, ?)", (post_id, uid))
+            # 別ワーカーで既に記録済みなら数えない
+            if c.rowcount:
+                added.setdefault(post_id, []).append(uid)
+        if added:
+            c.executemany("UPDATE match_posts SET likes = COALESCE(likes, 0) + ? WHERE id = ?",
+                          [(len(uids), post_id) for post_id, uids in added.items()])
+            ids = list(added)
+            c.execute(f"SELECT id, uid FROM match_posts WHERE id IN ({','.join('?' * len(ids))})", ids)
+            # いいねされた投稿者にポイント
+            earned = {}
+            for post_id, owner in c.fetchall():
+                if owner:
+                    n = sum(1 for uid in added[post_id] if uid != owner)
+                    if n:
+                        earned[owner] = earned.get(owner, 0) + n
+            for owner, n in earned.items():
+                award_points(c, owner, n * POINTS_LIKE_RECEIVED, 'like_received')
+        if posts:
+            # シャードに書いたチャット投稿の分（本体DBの posts トリガーの代わり）
+            rooms, posters = {}, {}
+            for room_id, post_id, uid in posts:
+                count, last_id, last_uid = rooms.get(room_id, (0, 0, None))
+                rooms[room_id] = (count + 1, post_id, uid) if post_id > last_id else (count + 1, last_id, last_uid)
+                posters[uid] = posters.get(uid, 0) + 1
+            # SET の右辺は更新前の値で計算される
+            c.executemany("""
+                UPDATE room_stats
+                SET post_count = post_count + ?,
+                    last_uid = CASE WHEN ? > last_post_id THEN ? ELSE last_uid END,
+                    last_post_id = MAX(last_post_id, ?),
+                    last_post_at = CURRENT_TIMESTAMP
+                WHERE room_id = ?
+            """, [(count, last_id, last_uid, last_id, room_id) for room_id, (count, last_id, last_uid) in rooms.items()])
+            for uid, n in posters.items():
+                award_points(c, uid, n * POINTS_CHAT_POST, 'chat_post')
+        conn.commit()
+        # いいね数が変わったので一覧を消す
+        if added:
+            response_cache.invalidate('match_idols')
+        if posts:
+            response_cache.invalidate('rooms')
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['pending'] = self.pending
+            data['durability'] = app.config['COUNTER_DURABILITY']
+        data['avg_flush_ms'] = data['flush_time'] * 1000 / data['flushes'] if data['flushes'] else 0.0
+        return data
+
+counter_buffer = CounterBuffer()
+# 正常終了時（gunicornのSIGTERMなど）に残りを書き込む
+atexit.register(counter_buffer.flush)
+
 @app.route('/api/reaction', methods=['POST'])
+@rate_limited('reaction')
 def reaction():
     data = request.json
     post_id = data.get('post_id')
     reaction = data.get('reaction')
     if not post_id or not reaction:
         return jsonify({'error': 'パラメータが足りません'}), 400
-
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
-    if reaction == "like":
-        c.execute('UPDATE posts SET likes = COALESCE(likes,0)+1 WHERE id=?', (post_id,))
-    elif reaction == "heart":
-        c.execute('UPDATE posts SET hearts = COALESCE(hearts,0)+1 WHERE id=?', (post_id,))
-    else:
-        conn.close()
+    if reaction not in REACTION_COLUMNS:
         return jsonify({'error': '不明なリアクションです'}), 400
+    try:
+        post_id = int(post_id)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'パラメータが足りません'}), 400
 
-    conn.commit()
-    conn.close()
+    counter_buffer.add_reaction(post_id, reaction)
     return jsonify({'result': 'ok'})
 
+# マッチング投稿の一覧で使う列。uid（3列目）に with_authors で投稿者名を足して match_idol_dict に渡す
+MATCH_IDOL_COLUMNS = 'm.img_url, m.caption, m.id, m.uid, m.xAccount, m.idolName, m.likes'
+
+def match_idol_dict(row):
+    return {
+        "img_url": row[0],
+        "caption": row[1],
+        "id": row[2],
+        "username": row[7],
+        "xAccount": row[4],
+        "idolName": row[5],
+        "likes": row[6] if row[6] is not None else 0
+    }
+
 @app.route('/api/match_idols')
+@cached_response('match_idols')
 def api_match_idols():
-    feature = request.args.get('feature', '').strip()
-    conn = sqlite3.connect("idolapp.db")
+    # feature=#a#b のように複数指定できる。mode=and（既定）は全部を含む投稿、mode=or はどれかを含む投稿
+    tags = parse_tags(request.args.get('feature', '').strip())
+    mode = request.args.get('mode', 'and')
+    conn = get_db()
     c = conn.cursor()
-    if feature:
-        search_tag = feature.replace('＃', '#').replace(' ', '')
-        search_tag = search_tag.strip('#')
-        c.execute("""
-            SELECT m.img_url, m.caption, m.id, u.username, m.xAccount, m.idolName, m.likes
+    if tags:
+        # タグごとのインデックスを引いて積集合（OR なら和集合）を取る
+        op = ' UNION ' if mode == 'or' else ' INTERSECT '
+        ids_sql = op.join(['SELECT post_id FROM match_post_tags WHERE tag = ?'] * len(tags))
+        c.execute(f"""
+            SELECT {MATCH_IDOL_COLUMNS}
+            FROM ({ids_sql}) t
+            JOIN match_posts m ON m.id = t.post_id
+            WHERE m.deleted = 0
+            ORDER BY t.post_id DESC
+        """, tags)
+    else:
+        c.execute(f"""
+            SELECT {MATCH_IDOL_COLUMNS}
             FROM match_posts m
-            LEFT JOIN users u ON m.uid = u.uid
-            WHERE m.feature LIKE ?
+            WHERE m.deleted = 0
             ORDER BY m.id DESC
-        """, (f'%#{search_tag}#%',))
-    else:
+        """)
+    return rows_response(c, match_idol_dict, authors=3)
+
+# スワイプ用のデッキ（タグごとの投稿idをメモリに持ち、次のK件だけ返す）
+# 重複として印を付けた投稿（dup_of あり）はデッキに出さない
+app.config['DECK_PAGE_SIZE'] = int(os.getenv("DECK_PAGE_SIZE", "10"))
+app.config['DECK_MAX_PAGE_SIZE'] = int(os.getenv("DECK_MAX_PAGE_SIZE", "50"))
+app.config['DECK_TTL'] = float(os.getenv("DECK_TTL", "60"))
+
+class MatchPostIndex:
+    # マッチ投稿から作るメモリ上の索引（DeckIndex と DuplicateIndex）の読み直しと追いつき
+    # 他のワーカーの削除はTTLごとの読み直しで、追加は seen_id より新しい行だけ読んで拾う
+    # サブクラスは _read_all（全件の状態と最後のid）、_replace（lock内で差し替え）、_read_new、_add_row を書く
+    ttl_config = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # ensure で読んだ最後のid。手元で add した投稿では進めない（その前に他のワーカーが入れた投稿を飛ばさないように）
+        self.seen_id = 0
+        self.loaded_at = 0.0
+        self.stats = {'loads': 0, 'catchups': 0}
+
+    def _load(self, c):
+        state, last_id = self._read_all(c)
+        with self.lock:
+            self._replace(state)
+            self.seen_id = last_id
+            self.loaded_at = time.time()
+            self.stats['loads'] += 1
+
+    def ensure(self, c):
+        if time.time() - self.loaded_at > app.config[self.ttl_config]:
+            self._load(c)
+            return
+        rows = self._read_new(c, self.seen_id)
+        if rows:
+            for row in rows:
+                self._add_row(row)
+            with self.lock:
+                self.seen_id = max(self.seen_id, rows[-1][0])
+                self.stats['catchups'] += 1
+
+    def invalidate(self):
+        # まとめて消したときは次のリクエストで読み直す
+        with self.lock:
+            self.loaded_at = 0.0
+
+class DeckIndex(MatchPostIndex):
+    ttl_config = 'DECK_TTL'
+
+    def __init__(self):
+        super().__init__()
+        # 投稿idの昇順リスト（全体とタグごと）
+        self.ids = []
+        self.tags = {}
+        self.stats.update({'requests': 0, 'served': 0, 'skipped_liked': 0})
+
+    def _read_all(self, c):
+        c.execute("SELECT id FROM match_posts WHERE deleted = 0 AND dup_of IS NULL ORDER BY id")
+        ids = [row[0] for row in c.fetchall()]
         c.execute("""
-            SELECT m.img_url, m.caption, m.id, u.username, m.xAccount, m.idolName, m.likes
+            SELECT t.tag, t.post_id FROM match_post_tags t
+            JOIN match_posts m ON m.id = t.post_id
+            WHERE m.deleted = 0 AND m.dup_of IS NULL
+            ORDER BY t.tag, t.post_id
+        """)
+        tags = {}
+        for tag, post_id in c.fetchall():
+            tags.setdefault(tag, []).append(post_id)
+        return (ids, tags), ids[-1] if ids else 0
+
+    def _replace(self, state):
+        self.ids, self.tags = state
+
+    def _read_new(self, c, after_id):
+        c.execute("SELECT id, feature FROM match_posts WHERE id > ? AND deleted = 0 AND dup_of IS NULL ORDER BY id",
+                  (after_id,))
+        return c.fetchall()
+
+    def _add_row(self, row):
+        self.add(row[0], parse_tags(row[1]))
+
+    def add(self, post_id, tags):
+        with self.lock:
+            for ids in [self.ids] + [self.tags.setdefault(tag, []) for tag in tags]:
+                i = bisect.bisect_left(ids, post_id)
+                if i == len(ids) or ids[i] != post_id:
+                    ids.insert(i, post_id)
+
+    def remove(self, post_id):
+        with self.lock:
+            for ids in [self.ids] + list(self.tags.values()):
+                i = bisect.bisect_left(ids, post_id)
+                if i < len(ids) and ids[i] == post_id:
+                    del ids[i]
+
+    @staticmethod
+    def _below(ids, cursor):
+        # cursor より小さいidを新しい順に
+        for i in range(bisect.bisect_left(ids, cursor) - 1, -1, -1):
+            yield ids[i]
+
+    @staticmethod
+    def _contains(ids, post_id):
+        i = bisect.bisect_left(ids, post_id)
+        return i < len(ids) and ids[i] == post_id
+
+    def next_ids(self, tags, mode, cursor, limit, exclude):
+        with self.lock:
+            if not tags:
+                candidates = self._below(self.ids, cursor)
+            elif mode == 'or':
+                lists = [self.tags.get(tag, []) for tag in tags]
+                merged = heapq.merge(*(self._below(ids, cursor) for ids in lists), reverse=True)
+                candidates = (post_id for post_id, _ in itertools.groupby(merged))
+            else:
+                # 一番短いタグのリストを順に見て、他のタグにも入っているものだけ
+                lists = sorted((self.tags.get(tag, []) for tag in tags), key=len)
+                candidates = (post_id for post_id in self._below(lists[0], cursor)
+                              if all(self._contains(ids, post_id) for ids in lists[1:]))
+            result = []
+            skipped = 0
+            last = None
+            for post_id in candidates:
+                last = post_id
+                if post_id in exclude:
+                    skipped += 1
+                    continue
+                result.append(post_id)
+                if len(result) >= limit:
+                    break
+            self.stats['requests'] += 1
+            self.stats['served'] += len(result)
+            self.stats['skipped_liked'] += skipped
+        # 最後まで見たら次のカーソルはない
+        return result, (last if len(result) >= limit else None)
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['posts'] = len(self.ids)
+            data['tags'] = len(self.tags)
+        return data
+
+deck_index = DeckIndex()
+
+@app.route('/api/match_deck', methods=['POST'])
+def api_match_deck():
+    # idToken があれば自分がいいね済みの投稿を除く。cursor は前回の最後のid
+    data = request.get_json(silent=True) or {}
+    tags = parse_tags((data.get('feature') or '').strip())
+    mode = data.get('mode', 'and')
+    try:
+        limit = min(int(data.get('limit') or app.config['DECK_PAGE_SIZE']), app.config['DECK_MAX_PAGE_SIZE'])
+        cursor = int(data['cursor']) if data.get('cursor') else float('inf')
+    except (TypeError, ValueError):
+        return jsonify({'error': 'パラメータが不正です'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'パラメータが不正です'}), 400
+    conn = get_db()
+    c = conn.cursor()
+    exclude = set()
+    user = verify_token(data.get('idToken'))
+    if user:
+        c.execute("SELECT post_id FROM match_post_likes WHERE user_uid = ?", (user['uid'],))
+        exclude = {row[0] for row in c.fetchall()}
+        exclude |= counter_buffer.pending_likes(user['uid'])
+    deck_index.ensure(c)
+    ids, next_cursor = deck_index.next_ids(tags, mode, cursor, limit, exclude)
+    cards = []
+    if ids:
+        c.execute(f"""
+            SELECT {MATCH_IDOL_COLUMNS}
             FROM match_posts m
-            LEFT JOIN users u ON m.uid = u.uid
+            WHERE m.id IN ({','.join('?' * len(ids))}) AND m.deleted = 0
             ORDER BY m.id DESC
-        """)
-    idols = [
-        {
-            "img_url": row[0],
-            "caption": row[1],
-            "id": row[2],
-            "username": row[3],
-            "xAccount": row[4],
-            "idolName": row[5],
-            "likes": row[6] if row[6] is not None else 0
-        }
-        for row in c.fetchall()
-    ]
+        """, ids)
+        cards = [match_idol_dict(row) for row in with_authors(c.fetchall(), 3)]
+    return jsonify({'cards': cards, 'cursor': next_cursor})
+
+@app.route('/api/deck_stats')
+@stats_endpoint
+def api_deck_stats():
+    return jsonify(deck_index.snapshot())
+
+# マッチ投稿の近い画像（同じ写真の撮り直し・再圧縮・縮小）の検出
+# 64bitの差分ハッシュを16bitずつ4つの区間に分け、区間ごとに 値 -> 投稿id の辞書を持つ（multi-index hashing）
+# 距離 d 以内ならどれかの区間は d//4 bit以内しか違わない（鳩の巣原理）ので、各区間でその範囲の値だけ引いて
+# 出てきた候補の距離を測る（全件は見ない）
+# 索引に入れるのは重複でない投稿だけ。近い投稿があれば一番近いもの（同じ距離なら古いもの）を dup_of にする
+# MATCH_DUP_ACTION: flag（重複として保存し、デッキに出さない）/ reject（409で断る）/ off
+app.config['MATCH_DUP_DISTANCE'] = min(max(int(os.getenv("MATCH_DUP_DISTANCE", "6")), 0), 31)
+app.config['MATCH_DUP_ACTION'] = os.getenv("MATCH_DUP_ACTION", "flag")
+app.config['MATCH_DUP_TTL'] = float(os.getenv("MATCH_DUP_TTL", "60"))
+
+def phash_to_db(value):
+    # SQLiteのINTEGERは符号付き64bitなので、最上位bitが立っていれば負の数にして入れる
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def phash_from_db(value):
+    return value & 0xFFFFFFFFFFFFFFFF
+
+class DuplicateIndex(MatchPostIndex):
+    ttl_config = 'MATCH_DUP_TTL'
+    BANDS = 4
+    BAND_BITS = 16
+
+    def __init__(self, distance):
+        super().__init__()
+        self.distance = distance
+        # 1つの区間の中で反転させて引くbitの組み合わせ（0 = そのまま）
+        self.flips = [sum(1 << i for i in bits) for r in range(distance // self.BANDS + 1)
+                      for bits in itertools.combinations(range(self.BAND_BITS), r)]
+        self.tables = [{} for _ in range(self.BANDS)]
+        self.hashes = {}
+        self.stats.update({'queries': 0, 'candidates': 0, 'matches': 0})
+
+    def _keys(self, value):
+        mask = (1 << self.BAND_BITS) - 1
+        return [value >> (i * self.BAND_BITS) & mask for i in range(self.BANDS)]
+
+    def _insert(self, post_id, value):
+        self.hashes[post_id] = value
+        for table, key in zip(self.tables, self._keys(value)):
+            table.setdefault(key, set()).add(post_id)
+
+    def _read_all(self, c):
+        c.execute("SELECT id, phash FROM match_posts WHERE deleted = 0 AND dup_of IS NULL AND phash IS NOT NULL ORDER BY id")
+        rows = c.fetchall()
+        return rows, rows[-1][0] if rows else 0
+
+    def _replace(self, rows):
+        self.tables = [{} for _ in range(self.BANDS)]
+        self.hashes = {}
+        for post_id, value in rows:
+            self._insert(post_id, phash_from_db(value))
+
+    def _read_new(self, c, after_id):
+        c.execute("""
+            SELECT id, phash FROM match_posts
+            WHERE id > ? AND deleted = 0 AND dup_of IS NULL AND phash IS NOT NULL
+            ORDER BY id
+        """, (after_id,))
+        return c.fetchall()
+
+    def _add_row(self, row):
+        self.add(row[0], phash_from_db(row[1]))
+
+    def add(self, post_id, value):
+        with self.lock:
+            if post_id in self.hashes:
+                return
+            self._insert(post_id, value)
+
+    def remove(self, post_id):
+        with self.lock:
+            value = self.hashes.pop(post_id, None)
+            if value is None:
+                return
+            for table, key in zip(self.tables, self._keys(value)):
+                table[key].discard(post_id)
+                if not table[key]:
+                    del table[key]
+
+    def find(self, value):
+        # 距離 distance 以内の投稿を [(距離, 投稿id), ...] で近い順（同じ距離なら古い順）に返す
+        with self.lock:
+            candidates = set()
+            for table, key in zip(self.tables, self._keys(value)):
+                for flip in self.flips:
+                    ids = table.get(key ^ flip)
+                    if ids:
+                        candidates.update(ids)
+            found = []
+            for post_id in candidates:
+                distance = (self.hashes[post_id] ^ value).bit_count()
+                if distance <= self.distance:
+                    found.append((distance, post_id))
+            self.stats['queries'] += 1
+            self.stats['candidates'] += len(candidates)
+            self.stats['matches'] += bool(found)
+        found.sort()
+        return found
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['posts'] = len(self.hashes)
+            data['buckets'] = sum(len(table) for table in self.tables)
+            data['distance'] = self.distance
+        data['avg_candidates'] = data['candidates'] / data['queries'] if data['queries'] else 0.0
+        return data
+
+dup_index = DuplicateIndex(app.config['MATCH_DUP_DISTANCE'])
+
+@app.route('/api/dup_stats')
+@stats_endpoint
+def api_dup_stats():
+    return jsonify(dup_index.snapshot())
+
+match_cli = AppGroup('match', help='マッチ投稿')
+
+@match_cli.command('dedup')
+def match_dedup_command():
+    # 差分ハッシュのない投稿（この機能より前の投稿）をカード画像から埋めてから、古い順に近い画像を重複として印を付ける
+    # 何度実行してもよい（印の付いた投稿はそのまま）。各ワーカーは DECK_TTL / MATCH_DUP_TTL ごとの読み直しで拾う
+    import images
+    conn = sqlite3.connect(DB_PATH)
+    static_prefix = app.static_url_path + '/'
+    hashed = unreadable = 0
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, img_url FROM match_posts
+            WHERE id > ? AND deleted = 0 AND phash IS NULL
+            ORDER BY id LIMIT 500
+        """, (last_id,)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        paths = {}
+        for post_id, img_url in rows:
+            if not img_url or not img_url.startswith(static_prefix):
+                continue
+            path = os.path.join(app.static_folder, img_url[len(static_prefix):])
+            if os.path.isfile(path):
+                paths[post_id] = path
+        # デコードはプロセスプールで並べて行う
+        values = get_image_executor().map(images.file_dhash, list(paths.values()), chunksize=16)
+        updates = [(phash_to_db(value), post_id) for post_id, value in zip(paths, values) if value is not None]
+        conn.executemany("UPDATE match_posts SET phash = ? WHERE id = ?", updates)
+        conn.commit()
+        hashed += len(updates)
+        unreadable += len(rows) - len(updates)
+
+    index = DuplicateIndex(app.config['MATCH_DUP_DISTANCE'])
+    flagged = 0
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, phash FROM match_posts
+            WHERE id > ? AND deleted = 0 AND dup_of IS NULL AND phash IS NOT NULL
+            ORDER BY id LIMIT 5000
+        """, (last_id,)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for post_id, value in rows:
+            value = phash_from_db(value)
+            found = index.find(value)
+            if found:
+                updates.append((found[0][1], post_id))
+            else:
+                index.add(post_id, value)
+        conn.executemany("UPDATE match_posts SET dup_of = ? WHERE id = ?", updates)
+        conn.commit()
+        flagged += len(updates)
     conn.close()
-    return jsonify(idols)
+    print(f'hashed {hashed}, unreadable {unreadable}, flagged {flagged} (distance {index.distance}, originals {len(index.hashes)})')
+
+app.cli.add_command(match_cli)
 
 @app.route('/match')
 def match():
@@ -503,6 +3458,8 @@ def match_post_page():
     return render_template('match_post.html')
 
 @app.route('/api/match_post', methods=['POST'])
+@upload_limit('match_images')
+@rate_limited('match_post')
 def match_post():
     id_token = request.form.get('idToken')
     caption = request.form.get('caption')
@@ -515,29 +3472,46 @@ def match_post():
     uid = user['uid']
     if not file:
         return jsonify({'error': '画像がありません'}), 400
-    filename = secure_filename(file.filename)
-    save_dir = os.path.join('static', 'match_images')
-    os.makedirs(save_dir, exist_ok=True)
-    save_path = os.path.join(save_dir, filename)
-    file.save(save_path)
-    img_url = url_for('static', filename=f'match_images/{filename}')
+    try:
+        _, variants, _, phash = upload_image(file, 'match_images')
+    except Exception as e:
+        return image_error(e)
+    img_url = variants['card']
+    conn = get_db()
+    c = conn.cursor()
+    dup_of = None
+    if app.config['MATCH_DUP_ACTION'] != 'off':
+        dup_index.ensure(c)
+        found = dup_index.find(phash)
+        if found:
+            dup_of = found[0][1]
+    if dup_of and app.config['MATCH_DUP_ACTION'] == 'reject':
+        # 他の投稿が使っていなければ変換した画像も消す（upload_image が入れた uploads の行も一緒に消える）
+        remove_unused_images(c, {img_url: set(variants.values())})
+        conn.commit()
+        return jsonify({'error': '同じ画像の投稿がすでにあります', 'duplicate_of': dup_of}), 409
     # #で区切られていなければ自動で#で囲む（両端#付きにする）
+    tags = parse_tags(feature)
     if feature:
-        feature = feature.replace('＃', '#').replace(' ', '')
-        tags = [t for t in feature.split('#') if t.strip()]
         if tags:
             feature = '#' + '#'.join(tags) + '#'
         else:
             feature = ''
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
     idolName = request.form.get('idolName', '').strip()
     c.execute(
-        "INSERT INTO match_posts (img_url, caption, xAccount, uid, feature, idolName, likes) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (img_url, caption, xAccount, uid, feature, idolName, 0)
+        "INSERT INTO match_posts (img_url, caption, xAccount, uid, feature, idolName, likes, img_variants, phash, dup_of) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (img_url, caption, xAccount, uid, feature, idolName, 0, json.dumps(variants), phash_to_db(phash), dup_of)
     )
+    post_id = c.lastrowid
+    c.executemany("INSERT OR IGNORE INTO match_post_tags (tag, post_id) VALUES (?, ?)",
+                  [(tag, post_id) for tag in tags])
+    award_points(c, uid, POINTS_MATCH_POST, 'match_post')
     conn.commit()
-    conn.close()
+    response_cache.invalidate('match_idols')
+    if dup_of:
+        return jsonify({'result': 'ok', 'duplicate_of': dup_of})
+    deck_index.add(post_id, tags)
+    dup_index.add(post_id, phash)
     return jsonify({'result': 'ok'})
 
 @app.route('/match_tag_select')
@@ -552,12 +3526,20 @@ def delete_match_post():
     if not user:
         return jsonify({'error': '認証エラー'}), 401
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     # 自分の投稿だけ削除できるように
-    c.execute("DELETE FROM match_posts WHERE id=? AND uid=?", (post_id, uid))
-    conn.commit()
-    conn.close()
+    c.execute("SELECT id FROM match_posts WHERE id=? AND uid=?", (post_id, uid))
+    row = c.fetchone()
+    if row:
+        # 1件だけならその場でいいねと画像もまとめて消す
+        files = purge_match_posts(c, [row[0]])
+        conn.commit()
+        remove_unused_images(c, files)
+        conn.commit()
+        deck_index.remove(row[0])
+        dup_index.remove(row[0])
+        response_cache.invalidate('match_idols')
     return jsonify({'result': 'ok'})
 
 @app.route('/my_match_posts')
@@ -572,24 +3554,19 @@ def api_my_match_posts():
     if not user:
         return jsonify([]), 401
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
+    conn = get_db()
     c = conn.cursor()
     # idolNameも取得、likesも取得
-    c.execute("SELECT id, img_url, caption, xAccount, feature, idolName, likes FROM match_posts WHERE uid=? ORDER BY id DESC", (uid,))
-    posts = [
-        {
-            "id": row[0],
-            "img_url": row[1],
-            "caption": row[2],
-            "xAccount": row[3],
-            "feature": row[4],
-            "idolName": row[5],
-            "likes": row[6] if row[6] is not None else 0
-        }
-        for row in c.fetchall()
-    ]
-    conn.close()
-    return jsonify(posts)
+    c.execute("SELECT id, img_url, caption, xAccount, feature, idolName, likes FROM match_posts WHERE uid=? AND deleted = 0 ORDER BY id DESC", (uid,))
+    return rows_response(c, lambda row: {
+        "id": row[0],
+        "img_url": row[1],
+        "caption": row[2],
+        "xAccount": row[3],
+        "feature": row[4],
+        "idolName": row[5],
+        "likes": row[6] if row[6] is not None else 0
+    })
 
 @app.route('/api/delete_all_my_match_posts', methods=['POST'])
 def delete_all_my_match_posts():
@@ -598,24 +3575,263 @@ def delete_all_my_match_posts():
     if not user:
         return jsonify({'error': '認証エラー'}), 401
     uid = user['uid']
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
-    c.execute("DELETE FROM match_posts WHERE uid=?", (uid,))
-    conn.commit()
-    conn.close()
-    return jsonify({'result': 'ok'})
+    return jsonify({'result': 'ok', 'job_id': mark_match_posts_deleted(uid)})
 
 @app.route('/api/delete_all_match_posts', methods=['POST'])
 def delete_all_match_posts():
     # 必要なら管理者認証を追加してください
-    conn = sqlite3.connect("idolapp.db")
+    return jsonify({'result': 'ok', 'job_id': mark_match_posts_deleted(None)})
+
+def mark_match_posts_deleted(uid):
+    # uid が None なら全員分。すぐに一覧から隠し、実際の削除はバックグラウンドで行う
+    conn = get_db()
     c = conn.cursor()
-    c.execute("DELETE FROM match_posts")
+    if uid is None:
+        c.execute("UPDATE match_posts SET deleted = 1 WHERE deleted = 0")
+    else:
+        c.execute("UPDATE match_posts SET deleted = 1 WHERE uid = ? AND deleted = 0", (uid,))
+    job_id = delete_jobs.enqueue(c, 'match_posts', uid)
     conn.commit()
-    conn.close()
-    return jsonify({'result': 'ok'})
+    deck_index.invalidate()
+    response_cache.invalidate('match_idols')
+    delete_jobs.wake()
+    return job_id
+
+def purge_match_posts(c, ids):
+    # いいねと投稿を消す（タグと検索索引はトリガーで消える）
+    # 戻り値: img_url -> その投稿の画像ファイルのURL（各サイズ）
+    marks = ','.join('?' * len(ids))
+    c.execute(f"SELECT img_url, img_variants FROM match_posts WHERE id IN ({marks})", ids)
+    files = {}
+    for img_url, variants in c.fetchall():
+        files.setdefault(img_url, set()).update(json.loads(variants).values() if variants else [img_url])
+    # 消す投稿の重複として隠していた投稿は、一番古いものを元の投稿にして残りをそちらに付け替える
+    # （デッキと重複の索引には次の読み直しから入る）
+    c.execute(f"SELECT dup_of, id FROM match_posts WHERE dup_of IN ({marks}) AND id NOT IN ({marks}) ORDER BY id", ids + ids)
+    heirs = {}
+    updates = []
+    for original, post_id in c.fetchall():
+        heir = heirs.setdefault(original, post_id)
+        updates.append((None if heir == post_id else heir, post_id))
+    c.executemany("UPDATE match_posts SET dup_of = ? WHERE id = ?", updates)
+    c.execute(f"DELETE FROM match_post_likes WHERE post_id IN ({marks})", ids)
+    c.execute(f"DELETE FROM match_posts WHERE id IN ({marks})", ids)
+    return files
+
+def remove_unused_images(c, files):
+    # 同じ画像は内容のハッシュで共有しているので、他の投稿がまだ img_url で使っていれば全サイズ残す
+    # uploads の行も消すので呼び出し側でcommitする
+    static_prefix = app.static_url_path + '/'
+    image_dir = os.path.join(app.static_folder, 'match_images') + os.sep
+    removed = 0
+    unused = []
+    for img_url, urls in files.items():
+        c.execute("SELECT 1 FROM match_posts WHERE img_url = ? LIMIT 1", (img_url,))
+        if c.fetchone():
+            continue
+        unused.append(img_url)
+        for url in urls:
+            if not url or not url.startswith(static_prefix):
+                continue
+            path = os.path.normpath(os.path.join(app.static_folder, url[len(static_prefix):]))
+            if not path.startswith(image_dir):
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    forget_uploads(c, 'match_images', unused)
+    return removed
+
+# 削除ジョブ（delete_jobs テーブルが正。ワーカーの再起動後も続きから消す）
+# 1バッチずつ別トランザクションにして、合間に書き込みロックを手放す
+app.config['DELETE_BATCH_SIZE'] = int(os.getenv("DELETE_BATCH_SIZE", "200"))
+app.config['DELETE_BATCH_PAUSE'] = float(os.getenv("DELETE_BATCH_PAUSE", "0.05"))
+app.config['DELETE_POLL'] = float(os.getenv("DELETE_POLL", "30"))
+app.config['DELETE_JOB_LEASE'] = float(os.getenv("DELETE_JOB_LEASE", "60"))
+
+class DeleteJobs:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.stats = {'jobs': 0, 'batches': 0, 'rows': 0, 'files': 0, 'errors': 0, 'batch_time': 0.0}
+
+    def enqueue(self, c, kind, target):
+        # 呼び出し側が印付けと同じトランザクションでcommitする
+        if kind == 'room':
+            # 部屋の投稿はシャードにあることがある
+            posts_c = get_posts_db(target).cursor()
+            posts_c.execute("SELECT COUNT(*) FROM posts WHERE room_id = ?", (target,))
+            total = posts_c.fetchone()[0]
+        else:
+            if target is None:
+                c.execute("SELECT COUNT(*) FROM match_posts WHERE deleted = 1")
+            else:
+                c.execute("SELECT COUNT(*) FROM match_posts WHERE uid = ? AND deleted = 1", (target,))
+            total = c.fetchone()[0]
+        c.execute("INSERT INTO delete_jobs (kind, target, total) VALUES (?, ?, ?)",
+                  (kind, None if target is None else str(target), total))
+        return c.lastrowid
+
+    def wake(self):
+        self._ensure_started()
+        self.wakeup.set()
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                while self.run_next():
+                    pass
+            except Exception:
+                with self.lock:
+                    self.stats['errors'] += 1
+                app.logger.exception('削除ジョブに失敗しました')
+            self.wakeup.wait(app.config['DELETE_POLL'])
+            self.wakeup.clear()
+
+    def _claim(self, conn):
+        # 他のワーカーが処理中（リースが切れていない）のジョブは取らない
+        now = time.time()
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, kind, target FROM delete_jobs
+            WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?)
+            ORDER BY id LIMIT 1
+        """, (now - app.config['DELETE_JOB_LEASE'],))
+        job = c.fetchone()
+        if job is None:
+            return None
+        c.execute("""
+            UPDATE delete_jobs SET status = 'running', claimed_at = ?
+            WHERE id = ? AND (status = 'pending' OR (status = 'running' AND claimed_at < ?))
+        """, (now, job[0], now - app.config['DELETE_JOB_LEASE']))
+        conn.commit()
+        return job if c.rowcount else None
+
+    def run_next(self):
+        # 1件のジョブを最後まで処理したら True
+        conn = db_pool.acquire()
+        try:
+            job = self._claim(conn)
+            if job is None:
+                return False
+            job_id, kind, target = job
+            try:
+                while self._batch(conn, job_id, kind, target):
+                    time.sleep(app.config['DELETE_BATCH_PAUSE'])
+            except Exception as e:
+                conn.rollback()
+                conn.execute("UPDATE delete_jobs SET status = 'failed', error = ? WHERE id = ?", (str(e), job_id))
+                conn.commit()
+                raise
+            with self.lock:
+                self.stats['jobs'] += 1
+            return True
+        finally:
+            db_pool.release(conn)
+
+    def _batch(self, conn, job_id, kind, target):
+        start = time.perf_counter()
+        c = conn.cursor()
+        size = app.config['DELETE_BATCH_SIZE']
+        files = {}
+        if kind == 'room':
+            if post_shards.enabled:
+                ids = self._delete_shard_posts(int(target), size)
+            else:
+                c.execute("SELECT id FROM posts WHERE room_id = ? LIMIT ?", (target, size))
+                ids = [row[0] for row in c.fetchall()]
+                if ids:
+                    c.execute(f"DELETE FROM posts WHERE id IN ({','.join('?' * len(ids))})", ids)
+            if not ids:
+                c.execute("DELETE FROM rooms WHERE id = ? AND deleted = 1", (target,))
+        else:
+            if target is None:
+                c.execute("SELECT id FROM match_posts WHERE deleted = 1 LIMIT ?", (size,))
+            else:
+                c.execute("SELECT id FROM match_posts WHERE uid = ? AND deleted = 1 LIMIT ?", (target, size))
+            ids = [row[0] for row in c.fetchall()]
+            if ids:
+                files = purge_match_posts(c, ids)
+        if ids:
+            c.execute("UPDATE delete_jobs SET done = done + ?, claimed_at = ? WHERE id = ?",
+                      (len(ids), time.time(), job_id))
+        else:
+            c.execute("UPDATE delete_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+        conn.commit()
+        # ファイルはcommitしてから消す（失敗してやり直しても画像だけ無くなることがない）
+        removed = remove_unused_images(c, files) if files else 0
+        conn.commit()
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['rows'] += len(ids)
+            self.stats['files'] += removed
+            self.stats['batch_time'] += time.perf_counter() - start
+        return bool(ids)
+
+    def _delete_shard_posts(self, room_id, size):
+        # シャード側は先にcommitする（進み具合の更新が失敗しても、次は残りから消すだけ）
+        shard = post_shards.shard_of(room_id)
+        conn = post_shards.acquire(shard)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT id FROM posts WHERE room_id = ? LIMIT ?", (room_id, size))
+            ids = [row[0] for row in c.fetchall()]
+            if ids:
+                c.execute(f"DELETE FROM posts WHERE id IN ({','.join('?' * len(ids))})", ids)
+                conn.commit()
+            return ids
+        finally:
+            post_shards.release(shard, conn)
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+        data['avg_batch_ms'] = data['batch_time'] * 1000 / data['batches'] if data['batches'] else 0.0
+        return data
+
+delete_jobs = DeleteJobs()
+
+@app.before_request
+def resume_delete_jobs():
+    # 再起動前に残っていたジョブも拾うよう、ワーカーごとに最初のリクエストで起動する
+    delete_jobs._ensure_started()
+
+@app.route('/api/delete_jobs/<int:job_id>')
+def api_delete_job(job_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, kind, target, status, total, done, error, created_at, finished_at FROM delete_jobs WHERE id = ?",
+              (job_id,))
+    row = c.fetchone()
+    if not row:
+        return jsonify({'error': 'ジョブがありません'}), 404
+    return jsonify({
+        'id': row[0],
+        'kind': row[1],
+        'target': row[2],
+        'status': row[3],
+        'total': row[4],
+        'done': row[5],
+        'progress': min(1.0, row[5] / row[4]) if row[4] else (1.0 if row[3] == 'done' else 0.0),
+        'error': row[6],
+        'created_at': row[7],
+        'finished_at': row[8]
+    })
 
 @app.route('/api/like_match_post', methods=['POST'])
+@rate_limited('like')
 def like_match_post():
     data = request.get_json()
     post_id = data.get('post_id')
@@ -625,19 +3841,279 @@ def like_match_post():
         return jsonify({'result': 'error', 'error': '認証エラー'}), 401
     uid = user['uid']
 
-    conn = sqlite3.connect("idolapp.db")
-    c = conn.cursor()
-    # すでにいいねしているか確認
-    c.execute("SELECT 1 FROM match_post_likes WHERE post_id=? AND user_uid=?", (post_id, uid))
-    if c.fetchone():
-        conn.close()
+    try:
+        post_id = int(post_id)
+    except (TypeError, ValueError):
+        return jsonify({'result': 'error', 'error': '投稿が指定されていません'}), 400
+    # すでにいいねしているか確認し、記録とカウント加算はまとめて書き込む
+    if not counter_buffer.add_like(post_id, uid):
         return jsonify({'result': 'error', 'error': 'すでにいいねしています'})
-    # いいね記録＆カウント加算
-    c.execute("INSERT INTO match_post_likes (post_id, user_uid) VALUES (?, ?)", (post_id, uid))
-    c.execute("UPDATE match_posts SET likes = COALESCE(likes, 0) + 1 WHERE id = ?", (post_id,))
-    conn.commit()
-    conn.close()
     return jsonify({'result': 'ok'})
 
+# 全文検索
+# trigram は3文字未満の語を索引から引けないので、そのときは LIKE で新しい順に探す
+# よくある語だと一致が多すぎて全件の関連度計算が重いので、新しい方から SEARCH_RANK_WINDOW 件の中で順位を付ける
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+app.config['SEARCH_RANK_WINDOW'] = int(os.getenv("SEARCH_RANK_WINDOW", "2000"))
+
+def search_terms(q):
+    return [t for t in q.replace('\u3000', ' ').split(' ') if t][:8]
+
+def fts_query(terms):
+    # 記号を演算子として解釈させないよう1語ずつ "" で囲む（全部を含むものを探す）
+    return ' '.join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search_posts(c, terms, room_id, order, window, limit, offset):
+    if post_shards.enabled:
+        return search_post_shards(c, terms, room_id, order, window, limit, offset)
+    where = ''
+    params = []
+    if room_id:
+        where = 'AND p.room_id = ?'
+        params.append(room_id)
+    if all(len(t) >= 3 for t in terms):
+        c.execute(f"""
+            SELECT p.id, p.room_id, r.name, p.uid, p.content
+            FROM (
+                SELECT f.rowid AS id, f.rank AS rank
+                FROM posts_fts f
+                JOIN posts p ON p.id = f.rowid
+                WHERE posts_fts MATCH ? {where}
+                ORDER BY f.rowid DESC
+                LIMIT ?
+            ) hit
+            JOIN posts p ON p.id = hit.id
+            LEFT JOIN rooms r ON r.id = p.room_id
+            WHERE COALESCE(r.deleted, 0) = 0
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        """, [fts_query(terms)] + params + [window, limit, offset])
+    else:
+        likes = ' AND '.join(["p.content LIKE ? ESCAPE '\\'"] * len(terms))
+        c.execute(f"""
+            SELECT p.id, p.room_id, r.name, p.uid, p.content
+            FROM posts p
+            LEFT JOIN rooms r ON r.id = p.room_id
+            WHERE {likes} {where} AND COALESCE(r.deleted, 0) = 0
+            ORDER BY p.id DESC
+            LIMIT ? OFFSET ?
+        """, [like_pattern(t) for t in terms] + params + [limit, offset])
+    return [
+        {
+            'id': row[0],
+            'room_id': row[1],
+            'room_name': row[2],
+            'uid': row[3],
+            'username': row[5],
+            'content': row[4]
+        } for row in with_authors(c.fetchall(), 3)
+    ]
+
+def search_post_shards(c, terms, room_id, order, window, limit, offset):
+    # シャードごとに先頭 offset + limit 件まで探して並べ直す（部屋を指定すれば1つのシャードだけ）
+    # 関連度はシャードごとの統計で計算されるので、シャードをまたぐ順位はおおよそ
+    shards = [post_shards.shard_of(room_id)] if room_id else range(post_shards.count)
+    where, params = ('AND p.room_id = ?', [room_id]) if room_id else ('', [])
+    rows = []
+    for shard in shards:
+        sc = get_shard_db(shard).cursor()
+        if all(len(t) >= 3 for t in terms):
+            sc.execute(f"""
+                SELECT hit.id, p.room_id, p.uid, p.content, hit.rank
+                FROM (
+                    SELECT f.rowid AS id, f.rank AS rank
+                    FROM posts_fts f
+                    JOIN posts p ON p.id = f.rowid
+                    WHERE posts_fts MATCH ? {where}
+                    ORDER BY f.rowid DESC
+                    LIMIT ?
+                ) hit
+                JOIN posts p ON p.id = hit.id
+                ORDER BY {order}
+                LIMIT ?
+            """, [fts_query(terms)] + params + [window, offset + limit])
+        else:
+            likes = ' AND '.join(["p.content LIKE ? ESCAPE '\\'"] * len(terms))
+            sc.execute(f"""
+                SELECT p.id, p.room_id, p.uid, p.content, 0
+                FROM posts p
+                WHERE {likes} {where}
+                ORDER BY p.id DESC
+                LIMIT ?
+            """, [like_pattern(t) for t in terms] + params + [offset + limit])
+        rows += sc.fetchall()
+    # 部屋名は本体DBから。削除中の部屋の投稿は除く
+    room_ids = list({row[1] for row in rows})
+    names = {}
+    if room_ids:
+        c.execute(f"SELECT id, name FROM rooms WHERE deleted = 0 AND id IN ({','.join('?' * len(room_ids))})", room_ids)
+        names = dict(c.fetchall())
+    rows = [row for row in rows if row[1] in names]
+    if 'rank' in order:
+        rows.sort(key=lambda row: (row[4], -row[0]))
+    else:
+        rows.sort(key=lambda row: -row[0])
+    return [
+        {
+            'id': row[0],
+            'room_id': row[1],
+            'room_name': names[row[1]],
+            'uid': row[2],
+            'username': row[5],
+            'content': row[3]
+        } for row in with_authors(rows[offset:offset + limit], 2)
+    ]
+
+def search_match_posts(c, terms, order, window, limit, offset):
+    if all(len(t) >= 3 for t in terms):
+        c.execute(f"""
+            SELECT {MATCH_IDOL_COLUMNS}
+            FROM (
+                SELECT rowid AS id, rank
+                FROM match_posts_fts
+                WHERE match_posts_fts MATCH ?
+                ORDER BY rowid DESC
+                LIMIT ?
+            ) hit
+            JOIN match_posts m ON m.id = hit.id
+            WHERE m.deleted = 0
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        """, (fts_query(terms), window, limit, offset))
+    else:
+        likes = ' AND '.join(["(m.caption LIKE ? ESCAPE '\\' OR m.idolName LIKE ? ESCAPE '\\')"] * len(terms))
+        params = [p for t in terms for p in (like_pattern(t), like_pattern(t))]
+        c.execute(f"""
+            SELECT {MATCH_IDOL_COLUMNS}
+            FROM match_posts m
+            WHERE {likes} AND m.deleted = 0
+            ORDER BY m.id DESC
+            LIMIT ? OFFSET ?
+        """, params + [limit, offset])
+    return [match_idol_dict(row) for row in with_authors(c.fetchall(), 3)]
+
+@app.route('/api/search')
+def api_search():
+    # type=posts（部屋の投稿、room_id で絞れる）か type=match（マッチング投稿のキャプションと名前）
+    # sort=rank（既定、関連度順）か sort=new（新しい順。よくある語で件数が多いときはこちらが速い）
+    terms = search_terms(request.args.get('q', '').strip())
+    kind = request.args.get('type', 'posts')
+    if not terms:
+        return jsonify({'error': '検索語を入力してください'}), 400
+    if kind not in ('posts', 'match'):
+        return jsonify({'error': '不明な検索対象です'}), 400
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    if request.args.get('sort') == 'new':
+        order, window = 'hit.id DESC', offset + limit
+    else:
+        order, window = 'hit.rank, hit.id DESC', max(app.config['SEARCH_RANK_WINDOW'], offset + limit)
+    conn = get_db()
+    c = conn.cursor()
+    if kind == 'posts':
+        results = search_posts(c, terms, request.args.get('room_id', type=int), order, window, limit, offset)
+    else:
+        results = search_match_posts(c, terms, order, window, limit, offset)
+    return jsonify({
+        'results': results,
+        'offset': offset,
+        'next_offset': offset + limit if len(results) == limit else None
+    })
+
+# 読み取り系のGETをまとめて1回で呼ぶ
+# {"idToken": "...", "requests": ["/api/rooms/1/bootstrap", "/api/ranking"]} -> {"responses": [{"path", "status", "body"}, ...]}
+# 各リクエストは同じDB接続を使い、トークンの検証も1回で済む（verify_token がリクエスト内で覚えている）
+BATCH_MAX_REQUESTS = 10
+BATCH_ENDPOINTS = {
+    'api_rooms', 'api_posts', 'room_bootstrap', 'api_profile_get', 'api_ranking', 'api_ranking_me', 'champion_image',
+    'api_match_idols', 'api_search', 'api_delete_job',
+}
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    data = request.get_json(silent=True) or {}
+    paths = data.get('requests')
+    if not isinstance(paths, list) or not paths or not all(isinstance(p, str) for p in paths):
+        return jsonify({'error': 'requests が必要です'}), 400
+    if len(paths) > BATCH_MAX_REQUESTS:
+        return jsonify({'error': f'一度に{BATCH_MAX_REQUESTS}件までです'}), 400
+    id_token = data.get('idToken') or request.headers.get('Authorization', '').replace('Bearer ', '')
+    headers = {'Authorization': 'Bearer ' + id_token} if id_token else {}
+    responses = [batch_get(path, headers) for path in paths]
+    return jsonify({'responses': responses})
+
+def batch_get(path, headers):
+    start = time.perf_counter()
+    # アプリコンテキスト（g）は外側のリクエストのものをそのまま使う
+    with app.test_request_context(path, headers=headers,
+                                  environ_base={'REMOTE_ADDR': request.remote_addr, 'idolapp.batch': True}):
+        if request.routing_exception is None and (request.endpoint not in BATCH_ENDPOINTS or 'stream' in request.args):
+            return {'path': path, 'status': 400, 'body': {'error': 'まとめて呼べないAPIです'}}
+        try:
+            resp = app.make_response(app.dispatch_request())
+        except HTTPException as e:
+            return {'path': path, 'status': e.code, 'body': {'error': e.name}}
+        route = request.url_rule.rule
+    metrics.observe('batch_request', (('route', route), ('status', str(resp.status_code))), time.perf_counter() - start)
+    return {'path': path, 'status': resp.status_code, 'body': resp.get_json(silent=True)}
+
+@app.route('/api/db_stats')
+@stats_endpoint
+def api_db_stats():
+    return jsonify(db_pool.snapshot())
+
+@app.route('/api/counter_stats')
+@stats_endpoint
+def api_counter_stats():
+    return jsonify(counter_buffer.snapshot())
+
+@app.route('/api/cache_stats')
+@stats_endpoint
+def api_cache_stats():
+    return jsonify(response_cache.snapshot())
+
+@app.route('/api/auth_stats')
+@stats_endpoint
+def api_auth_stats():
+    return jsonify(token_cache.snapshot())
+
+@app.route('/api/user_cache_stats')
+@stats_endpoint
+def api_user_cache_stats():
+    return jsonify(user_cache.snapshot())
+
+@app.route('/api/rate_limit_stats')
+@stats_endpoint
+def api_rate_limit_stats():
+    return jsonify({'rate_limit': rate_limiter.snapshot(), 'coalesce': single_flight.snapshot()})
+
+@app.route('/api/upload_stats')
+@stats_endpoint
+def api_upload_stats():
+    return jsonify(upload_store.snapshot())
+
+# Prometheus形式の計測値（gunicornではワーカーごとの値になる）
+@app.route('/metrics')
+@stats_endpoint
+def api_metrics():
+    lines = metrics.render()
+    sources = [('db_pool', db_pool), ('auth', token_cache), ('response_cache', response_cache),
+               ('stream', room_hub), ('counter', counter_buffer), ('deck', deck_index), ('users', user_cache),
+               ('delete_jobs', delete_jobs), ('rate_limit', rate_limiter), ('coalesce', single_flight),
+               ('post_shards', post_shards), ('uploads', upload_store), ('match_dup', dup_index)]
+    for prefix, source in sources:
+        for key, value in sorted(source.snapshot().items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f'# TYPE idolapp_{prefix}_{key} gauge')
+            lines.append(f'idolapp_{prefix}_{key} {value}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
+    upgrade_db()
     app.run(debug=True)
@@ -0,0 +1,320 @@
+# APIの負荷試験（Firebase不要）
+# 合成データのDBを作り、主要なAPIを同時アクセスで叩いて p50/p95/p99 とスループットを出す
+#
+# 使い方:
+#   python bench_api.py seed --scale small            # bench_api.db を作る
+#   python bench_api.py run                           # WSGIアプリを直接叩く
+#   python bench_api.py run --gunicorn --workers 1    # gunicornを起動してHTTPで叩く
+#   python bench_api.py run --compare bench_results/前回.json
+#
+# 結果は bench_results/ にJSONで保存されるので、前回との比較に使える
+import argparse
+import datetime
+import http.client
+import io
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB = os.path.join(HERE, 'bench_api.db')
+KEY_PATH = os.path.join(HERE, 'bench_api_key.pem')
+RESULTS_DIR = os.path.join(HERE, 'bench_results')
+
+SCALES = {
+    'small': {'users': 200, 'rooms': 20, 'posts': 20000, 'match_posts': 5000, 'likes': 20000},
+    'medium': {'users': 2000, 'rooms': 100, 'posts': 200000, 'match_posts': 50000, 'likes': 200000},
+    'large': {'users': 20000, 'rooms': 500, 'posts': 1000000, 'match_posts': 300000, 'likes': 1000000},
+}
+TAGS = ['かわいい', 'かっこいい', '黒髪', '金髪', 'ロング', 'ショート', '笑顔', 'ダンス', '歌', 'メガネ',
+        'センター', '新人', 'ベテラン', '元気', 'クール', 'ふわふわ', '高身長', '低身長', '関西', '沖縄']
+
+def setup_env(db_path):
+    # app を import する前に呼ぶ
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ['AUTH_TEST_MODE'] = '1'
+    os.environ['AUTH_TEST_KEY'] = KEY_PATH
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+
+def seed(db_path, scale):
+    setup_env(db_path)
+    import app
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    app.upgrade_db(db_path)
+    sizes = SCALES[scale]
+    rnd = random.Random(42)
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    uids = [f'bench_user_{i}' for i in range(sizes['users'])]
+    c.executemany("INSERT INTO users (uid, username, icon_url, profile, point, level) VALUES (?, ?, ?, ?, 0, 1)",
+                  [(u, f'ユーザー{i}', '/static/icons/default.png', 'よろしく') for i, u in enumerate(uids)])
+    c.executemany("INSERT INTO rooms (name, creator_uid) VALUES (?, ?)",
+                  [(f'部屋{i}', rnd.choice(uids)) for i in range(sizes['rooms'])])
+    c.executemany("INSERT INTO posts (room_id, uid, content) VALUES (?, ?, ?)",
+                  ((rnd.randint(1, sizes['rooms']), rnd.choice(uids), f'投稿{i} ' + 'あ' * rnd.randint(5, 80))
+                   for i in range(sizes['posts'])))
+    match_rows = []
+    tag_rows = []
+    for i in range(1, sizes['match_posts'] + 1):
+        tags = rnd.sample(TAGS, rnd.randint(1, 4))
+        match_rows.append(('/static/icons/default.png', f'キャプション{i}', '', rnd.choice(uids),
+                           '#' + '#'.join(tags) + '#', f'アイドル{i % 500}', 0))
+        tag_rows.extend((t, i) for t in tags)
+    c.executemany("INSERT INTO match_posts (img_url, caption, xAccount, uid, feature, idolName, likes) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?)", match_rows)
+    c.executemany("INSERT OR IGNORE INTO match_post_tags (tag, post_id) VALUES (?, ?)", tag_rows)
+    c.executemany("INSERT OR IGNORE INTO match_post_likes (post_id, user_uid) VALUES (?, ?)",
+                  ((rnd.randint(1, sizes['match_posts']), rnd.choice(uids)) for _ in range(sizes['likes'])))
+    c.execute("UPDATE match_posts SET likes = (SELECT COUNT(*) FROM match_post_likes l WHERE l.post_id = match_posts.id)")
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f'seeded {db_path} ({scale}: {sizes})')
+
+def sample_png():
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (640, 480), (255, 200, 80)).save(buf, 'PNG')
+    return buf.getvalue()
+
+def make_scenarios(db_path, tokens):
+    conn = sqlite3.connect(db_path)
+    rooms = conn.execute("SELECT COUNT(*) FROM rooms").fetchone()[0]
+    match_posts = conn.execute("SELECT MAX(id) FROM match_posts").fetchone()[0] or 1
+    conn.close()
+    png = sample_png()
+
+    def posts_get(rnd):
+        return 'GET', f'/api/posts?room_id={rnd.randint(1, rooms)}&limit=50', None
+    def match_idols(rnd):
+        tag = rnd.choice(TAGS)
+        return 'GET', '/api/match_idols?feature=' + quote('#' + tag), None
+    def like(rnd):
+        return 'POST', '/api/like_match_post', {'json': {'post_id': rnd.randint(1, match_posts),
+                                                         'idToken': rnd.choice(tokens)}}
+    def match_post(rnd):
+        return 'POST', '/api/match_post', {'form': {'idToken': rnd.choice(tokens), 'caption': 'bench',
+                                                    'xAccount': '', 'feature': '#' + rnd.choice(TAGS),
+                                                    'idolName': 'bench'},
+                                           'files': {'image': ('bench.png', png)}}
+    def rooms_get(rnd):
+        return 'GET', '/api/rooms', None
+
+    # (名前, リクエスト生成, 1スレッドあたりの回数の倍率)
+    return [
+        ('GET /api/posts', posts_get, 1.0),
+        ('GET /api/match_idols', match_idols, 0.2),
+        ('POST /api/like_match_post', like, 1.0),
+        ('POST /api/match_post', match_post, 0.1),
+        ('GET /api/rooms', rooms_get, 1.0),
+    ]
+
+def encode_multipart(form, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in form.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+class WsgiDriver:
+    def __init__(self, app_module):
+        self.app = app_module.app
+
+    def client(self):
+        return self.app.test_client()
+
+    def request(self, client, method, path, spec):
+        kwargs = {}
+        if spec and 'json' in spec:
+            kwargs['json'] = spec['json']
+        if spec and 'form' in spec:
+            data = dict(spec['form'])
+            for name, (filename, payload) in spec['files'].items():
+                data[name] = (io.BytesIO(payload), filename)
+            kwargs['data'] = data
+            kwargs['content_type'] = 'multipart/form-data'
+        resp = client.open(path, method=method, **kwargs)
+        resp.get_data()
+        return resp.status_code
+
+class HttpDriver:
+    def __init__(self, port):
+        self.port = port
+
+    def client(self):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+
+    def request(self, conn, method, path, spec):
+        headers = {}
+        body = None
+        if spec and 'json' in spec:
+            body = json.dumps(spec['json']).encode()
+            headers['Content-Type'] = 'application/json'
+        if spec and 'form' in spec:
+            body, headers['Content-Type'] = encode_multipart(spec['form'], spec['files'])
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status
+
+def run_scenario(driver, name, make_request, threads, requests_per_thread):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        client = driver.client()
+        local = []
+        local_errors = 0
+        for _ in range(requests_per_thread):
+            method, path, spec = make_request(rnd)
+            start = time.perf_counter()
+            try:
+                status = driver.request(client, method, path, spec)
+            except Exception:
+                status = 599
+                client = driver.client()
+            local.append(time.perf_counter() - start)
+            if status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    start = time.perf_counter()
+    ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - start
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'name': name,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': q[49] * 1000,
+        'p95_ms': q[94] * 1000,
+        'p99_ms': q[98] * 1000,
+    }
+
+def start_gunicorn(db_path, port, workers, worker_class):
+    env = dict(os.environ)
+    env.update({'DATABASE_PATH': db_path, 'AUTH_TEST_MODE': '1', 'AUTH_TEST_KEY': KEY_PATH})
+    cmd = [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}', '-w', str(workers),
+           '-k', worker_class, '--log-level', 'warning', 'app:app']
+    if worker_class == 'gevent':
+        cmd[cmd.index('-k') + 2:cmd.index('-k') + 2] = ['--worker-connections', '1000']
+    proc = subprocess.Popen(cmd, cwd=HERE, env=env)
+    # 起動を待つ
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/api/rooms')
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('gunicornが起動しませんでした')
+
+def print_table(results):
+    print(f"{'scenario':<28}{'req':>7}{'err':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['name']:<28}{r['requests']:>7}{r['errors']:>6}{r['throughput']:>10.1f}"
+              f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+
+def print_comparison(results, previous_path):
+    with open(previous_path, encoding='utf-8') as f:
+        previous = {r['name']: r for r in json.load(f)['results']}
+    print(f'\n前回 ({previous_path}) との比較:')
+    for r in results:
+        old = previous.get(r['name'])
+        if not old:
+            continue
+        def delta(key):
+            return (r[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f"{r['name']:<28} req/s {delta('throughput'):+6.1f}%  p50 {delta('p50_ms'):+6.1f}%  "
+              f"p95 {delta('p95_ms'):+6.1f}%  p99 {delta('p99_ms'):+6.1f}%")
+
+def run(args):
+    setup_env(args.db)
+    if not os.path.exists(args.db):
+        seed(args.db, args.scale)
+    import app
+    tokens = [app.issue_test_token(f'bench_user_{i}', expires_in=24 * 3600) for i in range(200)]
+    if args.gunicorn:
+        proc = start_gunicorn(args.db, args.port, args.workers, args.worker_class)
+        driver = HttpDriver(args.port)
+        mode = f'gunicorn-{args.worker_class}-w{args.workers}'
+    else:
+        proc = None
+        driver = WsgiDriver(app)
+        mode = 'wsgi'
+    results = []
+    try:
+        for name, make_request, weight in make_scenarios(args.db, tokens):
+            if args.only and args.only not in name:
+                continue
+            n = max(1, int(args.requests * weight))
+            results.append(run_scenario(driver, name, make_request, args.threads, n))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+    print(f'mode={mode} threads={args.threads}')
+    print_table(results)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f'{stamp}-{mode}.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'mode': mode, 'threads': args.threads, 'db': os.path.basename(args.db),
+                   'created_at': stamp, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f'\n保存しました: {path}')
+    if args.compare:
+        print_comparison(results, args.compare)
+
+def main():
+    parser = argparse.ArgumentParser(description='idolapp API benchmark')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_seed = sub.add_parser('seed')
+    p_seed.add_argument('--db', default=DEFAULT_DB)
+    p_seed.add_argument('--scale', choices=SCALES, default='small')
+    p_run = sub.add_parser('run')
+    p_run.add_argument('--db', default=DEFAULT_DB)
+    p_run.add_argument('--scale', choices=SCALES, default='small')
+    p_run.add_argument('--threads', type=int, default=8)
+    p_run.add_argument('--requests', type=int, default=200, help='1スレッドあたりの回数')
+    p_run.add_argument('--only', help='名前にこの文字列を含むシナリオだけ実行')
+    p_run.add_argument('--gunicorn', action='store_true')
+    p_run.add_argument('--workers', type=int, default=1)
+    p_run.add_argument('--worker-class', default='gevent')
+    p_run.add_argument('--port', type=int, default=8765)
+    p_run.add_argument('--compare')
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args.db, args.scale)
+    else:
+        run(args)
+
+if __name__ == '__main__':
+    main()
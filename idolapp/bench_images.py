@@ -0,0 +1,36 @@
+# 画像パイプラインの前後で1ページあたりの画像転送量を比べる
+# 使い方: python bench_images.py
+import os
+import tempfile
+import images
+
+STATIC = 'static'
+
+def originals(kind):
+    folder = os.path.join(STATIC, kind)
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))]
+
+def compare(kind, variant):
+    files = originals(kind)
+    before = after = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in files:
+            with open(path, 'rb') as f:
+                data = f.read()
+            _, names, _, _ = images.process_image(data, kind, tmp)
+            before += len(data)
+            after += os.path.getsize(os.path.join(tmp, kind, names[variant]))
+    return len(files), before, after
+
+# 部屋ページ: 投稿者アイコン（36px表示）、マッチページ: カード画像
+for label, kind, variant in [('room page icons', 'icons', 'avatar64'),
+                             ('match page cards', 'match_images', 'card')]:
+    count, before, after = compare(kind, variant)
+    if not count:
+        print(f'{label}: 画像なし')
+        continue
+    print(f'{label}: {count} files, before {before / 1024:.1f} KB, after {after / 1024:.1f} KB '
+          f'({after / before * 100:.1f}%)')
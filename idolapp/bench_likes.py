@@ -0,0 +1,51 @@
+# いいね・リアクションの同時書き込みの負荷試験（Firebase不要）
+# 使い方: AUTH_TEST_MODE=1 python bench_likes.py [batched|sync] [スレッド数] [1スレッドあたりの回数]
+# 実DBを汚さないよう DATABASE_PATH（既定: bench_likes.db）の作業用DBに書き込む
+import os
+import sys
+import threading
+import time
+os.environ.setdefault("AUTH_TEST_MODE", "1")
+os.environ.setdefault("DATABASE_PATH", "bench_likes.db")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+import app
+
+mode = sys.argv[1] if len(sys.argv) > 1 else 'batched'
+threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+per_thread = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+app.app.config['COUNTER_DURABILITY'] = mode
+app.upgrade_db()
+
+conn = app.sqlite3.connect(app.DB_PATH)
+conn.execute("INSERT INTO match_posts (img_url, caption, uid, likes) VALUES ('bench', 'bench', 'bench_owner', 0)")
+post_id = conn.execute("SELECT MAX(id) FROM match_posts").fetchone()[0]
+conn.execute("INSERT INTO posts (room_id, uid, content) VALUES (0, 'bench_owner', 'bench')")
+chat_id = conn.execute("SELECT MAX(id) FROM posts").fetchone()[0]
+conn.commit()
+
+tokens = [app.issue_test_token(f'bench_liker_{i}_{j}') for i in range(threads) for j in range(per_thread)]
+
+def worker(i):
+    client = app.app.test_client()
+    for j in range(per_thread):
+        client.post('/api/like_match_post', json={'post_id': post_id, 'idToken': tokens[i * per_thread + j]})
+        client.post('/api/reaction', json={'post_id': chat_id, 'reaction': 'heart'})
+
+start = time.perf_counter()
+ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+for t in ts:
+    t.start()
+for t in ts:
+    t.join()
+elapsed = time.perf_counter() - start
+app.counter_buffer.flush()
+
+total = threads * per_thread * 2
+likes = conn.execute("SELECT likes FROM match_posts WHERE id = ?", (post_id,)).fetchone()[0]
+hearts = conn.execute("SELECT hearts FROM posts WHERE id = ?", (chat_id,)).fetchone()[0]
+stats = app.counter_buffer.snapshot()
+print(f"mode={mode} threads={threads} requests={total}")
+print(f"throughput: {total / elapsed:.0f} req/s, transactions: {stats['transactions']} "
+      f"({stats['transactions'] / elapsed:.0f} commits/s)")
+print(f"likes={likes} hearts={hearts} (expected {threads * per_thread} each)")
+conn.close()
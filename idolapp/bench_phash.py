@@ -0,0 +1,54 @@
+# マッチ投稿の近い画像の検索時間（DuplicateIndex と全件の総当たり）を投稿数ごとに比べる
+# 使い方: python bench_phash.py [投稿数,...] [距離]
+#   例: python bench_phash.py 1000,10000,100000,1000000 6
+# DBは使わない。ランダムな差分ハッシュに、1割ほど数bitだけ変えた「撮り直し」を混ぜて索引に入れる
+# 実際の写真のハッシュはランダムより偏るので、区間ごとの候補数は /api/dup_stats の avg_candidates でも確かめる
+import os
+import random
+import sys
+import time
+os.environ.setdefault("AUTH_TEST_MODE", "1")
+import app
+
+sizes = [int(n) for n in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1000, 10000, 100000, 1000000]
+distance = int(sys.argv[2]) if len(sys.argv) > 2 else app.app.config['MATCH_DUP_DISTANCE']
+QUERIES = 2000
+rng = random.Random(0)
+
+def near(value, bits):
+    for i in rng.sample(range(64), bits):
+        value ^= 1 << i
+    return value
+
+def scan(hashes, value):
+    found = [((h ^ value).bit_count(), post_id) for post_id, h in hashes.items()]
+    return sorted(f for f in found if f[0] <= distance)
+
+print(f"distance={distance} queries={QUERIES}")
+print(f"{'posts':>8} {'build s':>8} {'index us':>9} {'scan us':>9} {'candidates':>10} {'hits':>6} {'mismatch':>8}")
+for size in sizes:
+    hashes = {}
+    for post_id in range(1, size + 1):
+        if hashes and rng.random() < 0.1:
+            hashes[post_id] = near(hashes[rng.randrange(1, post_id)], rng.randint(1, distance + 2))
+        else:
+            hashes[post_id] = rng.getrandbits(64)
+    index = app.DuplicateIndex(distance)
+    start = time.perf_counter()
+    for post_id, value in hashes.items():
+        index.add(post_id, value)
+    build = time.perf_counter() - start
+    # 半分は入っている画像の撮り直し、半分は新しい画像
+    queries = [near(hashes[rng.randint(1, size)], rng.randint(0, distance)) if i % 2 else rng.getrandbits(64)
+               for i in range(QUERIES)]
+    start = time.perf_counter()
+    results = [index.find(q) for q in queries]
+    index_us = (time.perf_counter() - start) / QUERIES * 1e6
+    # 総当たりは遅いので一部だけ測り、結果が同じかも確かめる
+    sample = queries[:max(20, QUERIES * 10000 // size)]
+    start = time.perf_counter()
+    mismatch = sum(scan(hashes, q) != results[i] for i, q in enumerate(sample))
+    scan_us = (time.perf_counter() - start) / len(sample) * 1e6
+    stats = index.snapshot()
+    print(f"{size:>8} {build:>8.2f} {index_us:>9.1f} {scan_us:>9.1f} {stats['avg_candidates']:>10.1f} "
+          f"{sum(bool(r) for r in results):>6} {mismatch:>8}")
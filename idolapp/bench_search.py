@@ -0,0 +1,54 @@
+# 全文検索（FTS5 trigram）と LIKE '%語%' の全件走査の比較
+# 使い方: python bench_search.py [投稿数]
+# 実DBを汚さないよう DATABASE_PATH（既定: bench_search.db）の作業用DBに書き込む
+import os
+import random
+import sys
+import time
+os.environ.setdefault("AUTH_TEST_MODE", "1")
+os.environ.setdefault("DATABASE_PATH", "bench_search.db")
+import app
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+COMMON = ['今日', 'の', 'ライブ', '最高', 'だった', 'チケット', '当選', 'MV', '公開', 'おめでとう',
+          'ありがとう', '明日', '配信', 'グッズ', '買った', '！']
+KANA = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン'
+rng = random.Random(0)
+# 投稿ごとに1つだけ入るまれな語（アイドル名などを想定）
+RARE = [''.join(rng.choices(KANA, k=4)) for _ in range(2000)]
+app.upgrade_db()
+
+conn = app.sqlite3.connect(app.DB_PATH)
+have = conn.execute("SELECT COUNT(*) FROM posts WHERE uid = 'bench_search'").fetchone()[0]
+if have < count:
+    conn.executemany("INSERT INTO posts (room_id, uid, content) VALUES (?, 'bench_search', ?)",
+                     [(i % 50, ''.join(rng.choices(COMMON, k=10)) + rng.choice(RARE)) for i in range(have, count)])
+    conn.commit()
+
+def timed(sql, params, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - start) / repeat * 1000, len(rows)
+
+# 3文字未満の語は trigram で引けないので /api/search も LIKE で探す
+print(f"posts={count}")
+print(f"{'term':10} {'LIKE ms':>9} {'FTS rank':>9} {'FTS new':>9} {'hits':>7}")
+for term in RARE[:3] + ['ライブ', 'チケット', 'おめでとう']:
+    like_ms, _ = timed("SELECT id FROM posts WHERE content LIKE ? ORDER BY id DESC LIMIT 20", (f'%{term}%',))
+    rank_ms, _ = timed("SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? ORDER BY rank LIMIT 20",
+                       (app.fts_query([term]),))
+    new_ms, _ = timed("SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? ORDER BY rowid DESC LIMIT 20",
+                      (app.fts_query([term]),))
+    hits = conn.execute("SELECT COUNT(*) FROM posts_fts WHERE posts_fts MATCH ?", (app.fts_query([term]),)).fetchone()[0]
+    print(f"{term:10} {like_ms:9.2f} {rank_ms:9.2f} {new_ms:9.2f} {hits:7}")
+
+# APIを通した時間（JOINと結果の組み立てを含む）
+client = app.app.test_client()
+for term in [RARE[0], 'ライブ']:
+    for sort in ('rank', 'new'):
+        start = time.perf_counter()
+        for _ in range(5):
+            client.get('/api/search', query_string={'q': term, 'sort': sort})
+        print(f"/api/search q={term} sort={sort}: {(time.perf_counter() - start) / 5 * 1000:.2f} ms")
+conn.close()
@@ -0,0 +1,92 @@
+# チャット投稿の同時書き込みのスループット（本体DBだけの場合と、シャード数を変えた場合）
+# 使い方: python bench_shards.py [秒数] [プロセス数] [シャード数,...]
+#   例: python bench_shards.py 10 8 0,1,2,4,8   （0 はシャードを使わない今まで通りの書き込み）
+# 実DBを汚さないよう bench_shards.db と bench_shards/ に書き込む
+# 書き込みロックの取り合いを見るため、ワーカーごとに別プロセスで POST /api/posts を投げ続ける
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+DB_PATH = 'bench_shards.db'
+SHARD_ROOT = 'bench_shards'
+ROOMS = 64
+
+def env_for(shards):
+    env = dict(os.environ)
+    env.update({
+        'AUTH_TEST_MODE': '1',
+        'DATABASE_PATH': DB_PATH,
+        'POST_SHARDS': str(shards),
+        'POST_SHARD_DIR': os.path.join(SHARD_ROOT, str(shards)),
+        'RATE_LIMIT_ENABLED': '0',
+        'METRICS_ENABLED': '0',
+    })
+    return env
+
+def seed(procs):
+    import app
+    app.upgrade_db()
+    conn = app.sqlite3.connect(app.DB_PATH)
+    conn.executemany("INSERT OR IGNORE INTO users (uid, username) VALUES (?, ?)",
+                     [(f'bench_{i}', f'bench{i}') for i in range(procs)])
+    if conn.execute("SELECT COUNT(*) FROM rooms").fetchone()[0] < ROOMS:
+        conn.executemany("INSERT INTO rooms (name, creator_uid) VALUES (?, 'bench_0')",
+                         [(f'部屋{i}',) for i in range(ROOMS)])
+    conn.commit()
+    conn.close()
+
+def worker(index, start_at, seconds):
+    # 子プロセス側: start_at から seconds 秒だけ投稿し続けて件数を出力する
+    import app
+    client = app.app.test_client()
+    token = app.issue_test_token(f'bench_{index}')
+    rnd = random.Random(index)
+    # 接続やシャードファイルの準備は計測に含めない
+    client.get('/api/posts?room_id=1&limit=1')
+    time.sleep(max(0, start_at - time.time()))
+    ok = errors = 0
+    end = start_at + seconds
+    while time.time() < end:
+        resp = client.post('/api/posts', json={'idToken': token, 'room_id': rnd.randint(1, ROOMS),
+                                               'content': 'ベンチマークの投稿です' * 3})
+        if resp.status_code == 200:
+            ok += 1
+        else:
+            errors += 1
+    app.counter_buffer.flush()
+    print(ok, errors)
+
+def run(shards, procs, seconds):
+    env = env_for(shards)
+    start_at = time.time() + 3
+    children = [subprocess.Popen([sys.executable, __file__, '--worker', str(i), str(start_at), str(seconds)],
+                                 env=env, stdout=subprocess.PIPE, text=True) for i in range(procs)]
+    ok = errors = 0
+    for child in children:
+        out, _ = child.communicate()
+        n, e = out.split()
+        ok += int(n)
+        errors += int(e)
+    return ok, errors
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        worker(int(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4]))
+        sys.exit()
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    procs = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    counts = [int(n) for n in sys.argv[3].split(',')] if len(sys.argv) > 3 else [0, 1, 2, 4, 8]
+    for path in (DB_PATH, DB_PATH + '-wal', DB_PATH + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(SHARD_ROOT, ignore_errors=True)
+    subprocess.run([sys.executable, '-c', f'import bench_shards; bench_shards.seed({procs})'],
+                   env=env_for(0), check=True)
+    print(f"processes={procs} seconds={seconds} cpus={os.cpu_count()}")
+    print(f"{'shards':>6} {'posts':>8} {'posts/s':>9} {'errors':>7}")
+    for shards in counts:
+        ok, errors = run(shards, procs, seconds)
+        print(f"{shards:>6} {ok:>8} {ok / seconds:>9.1f} {errors:>7}")
@@ -0,0 +1,15 @@
+# ワーカー起動時間（app.py の import にかかる時間）を測る
+# 使い方: python bench_startup.py [回数]
+import os
+import statistics
+import subprocess
+import sys
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+code = "import time; s = time.perf_counter(); import app; print(time.perf_counter() - s)"
+times = []
+for _ in range(runs):
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                         env=dict(os.environ), check=True)
+    times.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+print(f"import app: median {statistics.median(times):.0f} ms, min {min(times):.0f} ms, max {max(times):.0f} ms ({runs} runs)")
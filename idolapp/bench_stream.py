@@ -0,0 +1,72 @@
+# 大きな一覧APIのピークRSSの計測（まとめてjsonifyする場合とストリームで返す場合）
+# 使い方: AUTH_TEST_MODE=1 python bench_stream.py [件数]
+# 実DBを汚さないよう DATABASE_PATH（既定: bench_stream.db）の作業用DBに書き込む
+# ru_maxrss は増えるだけなので、1回の計測ごとに子プロセスを起動する
+import os
+import resource
+import subprocess
+import sys
+import time
+os.environ.setdefault("AUTH_TEST_MODE", "1")
+os.environ.setdefault("DATABASE_PATH", "bench_stream.db")
+os.environ.setdefault("RESPONSE_CACHE_SIZE", "0")
+
+CASES = [
+    ('match_idols', 'GET', '/api/match_idols'),
+    ('my_match_posts', 'POST', '/api/my_match_posts'),
+    ('posts', 'GET', '/api/posts?room_id=1&limit=200'),
+]
+MODES = [('list', ''), ('array', 'stream=1'), ('ndjson', 'stream=ndjson')]
+
+def seed(count):
+    import app
+    app.upgrade_db()
+    conn = app.sqlite3.connect(app.DB_PATH)
+    have = conn.execute("SELECT COUNT(*) FROM match_posts WHERE uid = 'bench_owner'").fetchone()[0]
+    if have < count:
+        conn.execute("INSERT OR IGNORE INTO users (uid, username) VALUES ('bench_owner', 'bench')")
+        conn.executemany(
+            "INSERT INTO match_posts (img_url, caption, xAccount, uid, feature, idolName, likes) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(f'/static/match_images/bench_{i}.webp', 'キャプション' * 10, 'https://x.com/bench',
+              'bench_owner', '#bench#', f'アイドル{i}', i % 50) for i in range(have, count)])
+        conn.executemany("INSERT INTO posts (room_id, uid, content) VALUES (1, 'bench_owner', ?)",
+                         [('メッセージ' * 20,) for _ in range(200)])
+        conn.commit()
+    conn.close()
+
+def measure(case, mode):
+    # 子プロセス側: 1回だけリクエストして、本文は読み捨てながらRSSの増分を測る
+    import app
+    _, method, path = next(c for c in CASES if c[0] == case)
+    query = dict(MODES)[mode]
+    if query:
+        path += ('&' if '?' in path else '?') + query
+    client = app.app.test_client()
+    token = app.issue_test_token('bench_owner')
+    # importや初回接続の分は除く
+    client.get('/api/posts?room_id=1&limit=1').close()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if method == 'POST':
+        resp = client.post(path, json={'idToken': token})
+    else:
+        resp = client.get(path)
+    size = 0
+    for chunk in resp.iter_encoded():
+        size += len(chunk)
+    resp.close()
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{case:15} {mode:7} {(after - before) / 1024:8.1f} MB {elapsed * 1000:8.0f} ms {size / 1024 / 1024:7.1f} MB body")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3])
+        sys.exit()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    seed(count)
+    print(f"rows={count} chunk={os.getenv('STREAM_CHUNK_ROWS', '500')}")
+    print(f"{'api':15} {'mode':7} {'peak RSS増分':>11} {'時間':>8} {'本文':>12}")
+    for case, _, _ in CASES:
+        for mode, _ in MODES:
+            subprocess.run([sys.executable, __file__, '--measure', case, mode], check=True)
@@ -0,0 +1,23 @@
+# verify_token のキャッシュ効果を測る（Firebase不要・オフライン）
+# 使い方: AUTH_TEST_MODE=1 python bench_token.py
+import os
+import time
+os.environ.setdefault("AUTH_TEST_MODE", "1")
+import app
+
+N = 2000
+tokens = [app.issue_test_token(f'bench_user_{i}') for i in range(100)]
+
+start = time.perf_counter()
+for t in tokens:
+    app.verify_token(t)
+miss = (time.perf_counter() - start) / len(tokens)
+
+start = time.perf_counter()
+for i in range(N):
+    app.verify_token(tokens[i % len(tokens)])
+hit = (time.perf_counter() - start) / N
+
+print(f"miss: {miss * 1e6:.1f} us/token")
+print(f"hit:  {hit * 1e6:.1f} us/token")
+print(app.token_cache.snapshot())
@@ -0,0 +1,107 @@
+# アップロード画像の変換処理
+# app.py からプロセスプールで呼ばれるので、ここでは app を import しない
+import hashlib
+import io
+import os
+from PIL import Image, ImageOps, features
+
+# 巨大画像（解凍爆弾）対策
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
+# 保存先ごとのサイズ: (名前, 最大辺px, 正方形に切り抜くか)
+VARIANTS = {
+    'icons': [('avatar64', 64, True), ('avatar128', 128, True)],
+    'match_images': [('card', 720, False), ('full', 1600, False)],
+    'champion_images': [('card', 800, False), ('full', 1600, False)],
+}
+
+def output_format():
+    # WebPが使えなければJPEGにする
+    if features.check('webp'):
+        return 'WEBP', 'webp'
+    return 'JPEG', 'jpg'
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def variant_names(digest, kind):
+    _, ext = output_format()
+    return {name: f'{digest[:32]}_{name}.{ext}' for name, _, _ in VARIANTS[kind]}
+
+def image_size(img):
+    # exifの回転を反映した縦横
+    width, height = img.size
+    if img.getexif().get(0x0112) in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+def dhash(img):
+    # 64bitの差分ハッシュ（9x8に縮めて横に隣り合う画素の明暗を並べる）
+    # 再圧縮・縮小・スクショの撮り直しでは数bitしか変わらないので、近い画像はハミング距離で探せる
+    small = img.convert('L').resize((9, 8), Image.LANCZOS)
+    px = small.load()
+    value = 0
+    for y in range(8):
+        for x in range(8):
+            value = value << 1 | (px[x, y] > px[x + 1, y])
+    return value
+
+def file_dhash(path):
+    # 保存済みの画像から（既存の投稿のバックフィル用）
+    with Image.open(path) as img:
+        img.draft('RGB', (64, 64))
+        return dhash(ImageOps.exif_transpose(img))
+
+def process_image(source, kind, static_dir, digest=None):
+    # 1回だけデコードして各サイズを書き出す。ファイル名は内容のハッシュなので同じ画像は作り直さない
+    # source はファイルのパスかバイト列。受け取り時にハッシュを取っていれば digest に渡す
+    # 戻り値: (ハッシュ, {サイズ名: ファイル名}, 元画像の(幅, 高さ), 差分ハッシュ)
+    if isinstance(source, bytes):
+        digest = digest or content_hash(source)
+        source = io.BytesIO(source)
+    elif digest is None:
+        digest = file_hash(source)
+    names = variant_names(digest, kind)
+    save_dir = os.path.join(static_dir, kind)
+    os.makedirs(save_dir, exist_ok=True)
+    if all(os.path.exists(os.path.join(save_dir, n)) for n in names.values()):
+        # 大きさはヘッダから、差分ハッシュは縮小してデコードした画像から
+        with Image.open(source) as img:
+            dims = image_size(img)
+            img.draft('RGB', (64, 64))
+            return digest, names, dims, dhash(ImageOps.exif_transpose(img))
+
+    fmt, _ = output_format()
+    img = Image.open(source)
+    dims = image_size(img)
+    img = ImageOps.exif_transpose(img)
+    img.load()
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if fmt == 'WEBP' and has_alpha:
+        img = img.convert('RGBA')
+    else:
+        img = img.convert('RGB')
+    phash = dhash(img)
+
+    for name, size, square in VARIANTS[kind]:
+        if square:
+            variant = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        else:
+            variant = img.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+        path = os.path.join(save_dir, names[name])
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        # exifなどのメタデータは渡さないので書き出し時に落ちる
+        if fmt == 'WEBP':
+            variant.save(tmp_path, fmt, quality=80, method=4)
+        else:
+            variant.save(tmp_path, fmt, quality=82, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+    return digest, names, dims, phash
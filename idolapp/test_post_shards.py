@@ -0,0 +1,59 @@
+# チャット投稿のシャード: 別のシャードの部屋に投稿しても /api/rooms が最近投稿のあった順になるか
+# 使い方: python -m pytest test_post_shards.py
+# app は import 時に環境変数を読むので、作業用のDBとシャードの置き場所を先に決める
+import os
+import tempfile
+import time
+
+WORK_DIR = tempfile.mkdtemp(prefix='idolapp_test_')
+os.environ.update({
+    'AUTH_TEST_MODE': '1',
+    'DATABASE_PATH': os.path.join(WORK_DIR, 'test.db'),
+    'POST_SHARDS': '2',
+    'POST_SHARD_DIR': os.path.join(WORK_DIR, 'post_shards'),
+    'RATE_LIMIT_ENABLED': '0',
+    'METRICS_ENABLED': '0',
+})
+import app
+
+def make_rooms(names):
+    conn = app.sqlite3.connect(app.DB_PATH)
+    conn.execute("INSERT OR IGNORE INTO users (uid, username) VALUES ('shard_test', 'test')")
+    ids = {}
+    for name in names:
+        ids[name] = conn.execute("INSERT INTO rooms (name, creator_uid) VALUES (?, 'shard_test')", (name,)).lastrowid
+    conn.commit()
+    conn.close()
+    return ids
+
+def test_rooms_ordered_by_last_post_across_shards():
+    app.upgrade_db()
+    names = ['busy', 'quiet1', 'quiet2', 'quiet3', 'quiet4']
+    rooms = make_rooms(names)
+    assert len({app.post_shards.shard_of(room_id) for room_id in rooms.values()}) == 2
+    client = app.app.test_client()
+    token = app.issue_test_token('shard_test')
+
+    def post(name):
+        resp = client.post('/api/posts', json={'idToken': token, 'room_id': rooms[name], 'content': name})
+        assert resp.status_code == 200
+        # 同じミリ秒の投稿はシャード番号の順になるので、時刻をずらす
+        time.sleep(0.002)
+
+    # 片方のシャードの部屋にだけ続けて投稿して、そのシャードのidを先に進めておく
+    for _ in range(20):
+        post('busy')
+    for name in names[1:]:
+        post(name)
+    app.counter_buffer.flush()
+
+    resp = client.get('/api/rooms', query_string={'limit': 10})
+    assert resp.status_code == 200
+    listed = [room['name'] for room in resp.get_json()['rooms'] if room['name'] in rooms]
+    assert listed == ['quiet4', 'quiet3', 'quiet2', 'quiet1', 'busy']
+
+    # 2ページに分けても同じ順に続く
+    first = client.get('/api/rooms', query_string={'limit': 2}).get_json()
+    second = client.get('/api/rooms', query_string={'limit': 10, 'cursor': first['cursor']}).get_json()
+    paged = [room['name'] for room in first['rooms'] + second['rooms'] if room['name'] in rooms]
+    assert paged == listed